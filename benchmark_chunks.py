@@ -0,0 +1,183 @@
+import csv
+import json
+import os
+import sys
+import tempfile
+from time import time
+import click
+import numpy as np
+import netCDF4
+import cf
+
+from get_chunkshape import get_chunkshape, greedy_chunkshape, profile_chunkshape, estimate_read_cost, CHUNK_PROFILES
+
+# Grid shapes we care about, with the axis type of each dimension
+GRIDS = {
+    'n1280_30day_1hr': ([720, 1920, 2560], ['T','Y','X']),
+    'n1280_odd_time': ([719, 1920, 2560], ['T','Y','X']),
+    'n1280_L85': ([4, 85, 1920, 2560], ['T','Z','Y','X']),
+    'n216_30day_1hr': ([720, 324, 432], ['T','Y','X']),
+    'n96_360day_day': ([360, 144, 192], ['T','Y','X']),
+}
+
+# Chunk strategies, each a function of (shape, axes, volume) giving a chunk shape
+STRATEGIES = {
+    'greedy': lambda shape, axes, volume: greedy_chunkshape(np.array(shape), volume),
+    'solver': lambda shape, axes, volume: get_chunkshape(np.array(shape), volume),
+    'time1': lambda shape, axes, volume: get_chunkshape(np.array(shape), volume, fixed={0:1}),
+}
+for _profile in CHUNK_PROFILES:
+    STRATEGIES[_profile] = (lambda profile: lambda shape, axes, volume:
+                                profile_chunkshape(np.array(shape), axes, volume, profile))(_profile)
+
+
+def synthetic_field(shape, axes, seed=0):
+    """
+    Make a field of the given shape with coordinates of the given axis types,
+    and some smooth structure plus noise in the data, so that it compresses
+    something like real data.
+    """
+    rng = np.random.default_rng(seed)
+    data = np.zeros(shape, dtype=np.float32)
+    for i, n in enumerate(shape):
+        view = [1]*len(shape)
+        view[i] = n
+        data += np.sin(np.linspace(0, 2*np.pi*(i+1), n, dtype=np.float32)).reshape(view)
+    data += 0.01*rng.standard_normal(shape, dtype=np.float32)
+
+    f = cf.Field(properties={'standard_name':'air_temperature', 'units':'K'})
+    coordinates = {
+        'T': {'standard_name':'time', 'units':'hours since 1980-01-01'},
+        'Z': {'standard_name':'model_level_number', 'units':'1', 'axis':'Z'},
+        'Y': {'standard_name':'latitude', 'units':'degrees_north'},
+        'X': {'standard_name':'longitude', 'units':'degrees_east'},
+    }
+    keys = []
+    for n, a in zip(shape, axes):
+        key = f.set_construct(cf.DomainAxis(n))
+        values = np.arange(n, dtype=float)
+        if a == 'Y':
+            values = np.linspace(-90, 90, n)
+        elif a == 'X':
+            values = np.linspace(0, 360, n, endpoint=False)
+        f.set_construct(cf.DimensionCoordinate(properties=coordinates[a], data=cf.Data(values)), axes=key)
+        keys.append(key)
+    f.set_data(cf.Data(data, units='K'), axes=keys)
+    return f
+
+
+def time_reads(path, axes, repeats=5, seed=0):
+    """
+    Time the typical reads from the (only) data variable in the file at path,
+    with the HDF5 chunk cache turned off so that each read goes to the file:
+    a point time series, a single map, and a regional box (a tenth of each
+    horizontal dimension, for all times). Returns the median latency in seconds
+    for each.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    with netCDF4.Dataset(path) as ds:
+        var = [v for v in ds.variables.values() if v.ndim == len(axes)][0]
+        var.set_auto_mask(False)
+        var.set_var_chunk_cache(0, 0, 0)
+        shape = var.shape
+        def index(query):
+            idx = []
+            for n, a in zip(shape, axes):
+                if query == 'timeseries':
+                    idx.append(slice(None) if a == 'T' else int(rng.integers(n)))
+                elif query == 'map':
+                    idx.append(slice(None) if a in 'YX' else int(rng.integers(n)))
+                else:
+                    if a == 'T':
+                        idx.append(slice(None))
+                    elif a in 'YX':
+                        start = int(rng.integers(n - n//10))
+                        idx.append(slice(start, start + max(n//10, 1)))
+                    else:
+                        idx.append(int(rng.integers(n)))
+            return tuple(idx)
+        for query in ('timeseries', 'map', 'region'):
+            latencies = []
+            for r in range(repeats):
+                e1 = time()
+                var[index(query)]
+                latencies.append(time()-e1)
+            results[query] = float(np.median(latencies))
+    return results
+
+
+def benchmark(grids=None, strategies=None, volume=1e6, compress=4, shuffle=True,
+                shrink=1, repeats=5, directory=None, logging=False):
+    """
+    For each grid and chunk strategy, write a synthetic field with cf.write, and
+    time the typical reads. The horizontal dimensions are divided by <shrink>
+    to make things manageable on small machines.
+    Returns a list of result dictionaries (one per grid and strategy).
+    """
+    grids = grids or list(GRIDS)
+    strategies = strategies or list(STRATEGIES)
+    rows = []
+    for grid in grids:
+        shape, axes = GRIDS[grid]
+        shape = [n//shrink if a in 'YX' else n for n, a in zip(shape, axes)]
+        f = synthetic_field(shape, axes)
+        nbytes = int(np.prod(shape))*4
+        for strategy in strategies:
+            chunks = STRATEGIES[strategy](shape, axes, volume)
+            f.data.nc_set_hdf5_chunksizes(chunks)
+            with tempfile.TemporaryDirectory(dir=directory) as tmp:
+                path = os.path.join(tmp, f'{grid}_{strategy}.nc')
+                e1 = time()
+                cf.write(f, path, compress=compress, shuffle=shuffle)
+                e2 = time()
+                size = os.path.getsize(path)
+                reads = time_reads(path, axes, repeats=repeats)
+            row = {'grid': grid, 'shape': shape, 'strategy': strategy, 'chunks': chunks,
+                   'chunk_bytes': int(np.prod(chunks))*4,
+                   'write_MBps': nbytes/1e6/(e2-e1),
+                   'compression_ratio': nbytes/size}
+            row.update({f'read_{k}_s': v for k, v in reads.items()})
+            row.update({f'chunks_{k}': v for k, v in estimate_read_cost(shape, chunks, axes).items()})
+            if logging:
+                print(row, file=sys.stderr)
+            rows.append(row)
+    return rows
+
+
+def write_table(rows, output, fmt='csv'):
+    """
+    Write the results as csv or json lines to output (a file object)
+    """
+    if fmt == 'json':
+        for row in rows:
+            output.write(json.dumps(row)+'\n')
+        return
+    columns = []
+    for row in rows:
+        columns += [k for k in row if k not in columns]
+    writer = csv.DictWriter(output, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({k: (' '.join(map(str, v)) if isinstance(v, list) else v) for k, v in row.items()})
+
+
+@click.command()
+@click.option('--grid', 'grids', multiple=True, type=click.Choice(list(GRIDS)), help='Grid(s) to use (default all)')
+@click.option('--strategy', 'strategies', multiple=True, type=click.Choice(list(STRATEGIES)), help='Chunk strategies (default all)')
+@click.option('--volume', default=1e6, help='Target chunk volume in bytes')
+@click.option('--compress', default=4, help='Compression level')
+@click.option('--shuffle/--no-shuffle', default=True)
+@click.option('--shrink', default=1, help='Divide the horizontal dimensions by this')
+@click.option('--repeats', default=5, help='Number of each read to time')
+@click.option('--format', 'fmt', default='csv', type=click.Choice(['csv', 'json']))
+@click.option('--output', type=click.File('w'), default='-')
+def main(grids, strategies, volume, compress, shuffle, shrink, repeats, fmt, output):
+    """ Benchmark chunk shapes for UM grids """
+    rows = benchmark(grids, strategies, volume=volume, compress=compress, shuffle=shuffle,
+                        shrink=shrink, repeats=repeats, logging=True)
+    write_table(rows, output, fmt)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
 import json
+import hashlib
+import os
+import pickle
+import socket
+import sys
 from pathlib import Path
 import cf
 
 COMMON_CONCEPT_JSONDIR = '/home/users/lawrence/hiresgw/hrcm'
+# Where to put the compiled index if we can't write next to the json
+COMMON_CONCEPT_CACHEDIR = Path.home()/'.cache'/'pp2nice'
+INDEX_VERSION = 2
 
 ncas_common_concept = {
     # This may not be the way to do this.
@@ -79,19 +87,126 @@ def verify_consistency():
         if v in names:
             print('Duplicate for ',n,v)
         
+def _dimension_collapse_options(options):
+    """ 
+    For a given standard name, there will be multiple possible
+    common concepts. We can leave the issue of table and 
+    cell methods to other bits of code, but here we collapse down 
+    to options with the same dimensionality
+    """
+    dimension_view = {}
+    for table,values in options.items():
+        for option, value in values.items():
+            if value['dimensions'] not in dimension_view:
+                dimension_view[value['dimensions']] = option
+    return dimension_view
+
+
+def _index_source(jfile):
+    """ 
+    What the compiled index depends on: if any of this changes, it is rebuilt
+    """
+    stat = Path(jfile).stat()
+    ncas = json.dumps(ncas_common_concept, sort_keys=True).encode()
+    return {'version': INDEX_VERSION,
+            'json': str(Path(jfile).resolve()),
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'ncas': hashlib.md5(ncas).hexdigest(),
+            'cf': cf.__version__}
+
+
+def default_index_file(jfile):
+    """ 
+    The compiled index lives next to the json if we can write there,
+    otherwise in our cache directory.
+    """
+    jfile = Path(jfile)
+    if os.access(jfile.parent, os.W_OK):
+        return jfile.with_suffix('.idx')
+    return COMMON_CONCEPT_CACHEDIR/(jfile.stem+'.idx')
+
+
+def compile_concepts(jfile, index_file=None):
+    """ 
+    Compile the common concept json and the ncas common concepts into an 
+    index keyed by standard name (with the dimension collapsed options already
+    resolved) and by (ncas) long name.
+    The index is written (with pickle) as a header, describing what it was 
+    built from, followed by the index itself, so that staleness can be checked
+    without loading the whole thing.
+    """
+    if index_file is None:
+        index_file = default_index_file(jfile)
+    with open(jfile,'r') as jdata:
+        db = json.load(jdata)
+    index = {
+        'standard_names': {k:_dimension_collapse_options(v) for k,v in db['index'].items()},
+        'ncas': dict(ncas_common_concept['index']),
+    }
+    index_file = Path(index_file)
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    # many tasks (on many nodes) may rebuild a stale index at once, so each writes its own file
+    tmp = f'{index_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp,'wb') as ifile:
+        pickle.dump(_index_source(jfile), ifile)
+        pickle.dump(index, ifile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, index_file)
+    return index
+
+
+def load_concepts(jfile, index_file=None):
+    """ 
+    Load the compiled common concept index, rebuilding it first
+    if it is missing or out of date with respect to the json.
+    """
+    if index_file is None:
+        index_file = default_index_file(jfile)
+    try:
+        with open(index_file,'rb') as ifile:
+            if pickle.load(ifile) == _index_source(jfile):
+                return pickle.load(ifile)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    return compile_concepts(jfile, index_file)
+
+
 class CommonConcepts:
-    def __init__(self):
-        jfile = Path(COMMON_CONCEPT_JSONDIR)/'cmip6_common_concept.json'
-        with open(jfile,'r') as jdata:
-            self.db = json.load(jdata)
+    def __init__(self, jfile=None, index_file=None):
+        """ 
+        The compiled index (and the raw json) are only loaded when first needed.
+        """
+        if jfile is None:
+            jfile = Path(COMMON_CONCEPT_JSONDIR)/'cmip6_common_concept.json'
+        self.jfile = jfile
+        self.index_file = index_file
         self.ncasdb = ncas_common_concept
-        cf.load_stash2standard_name() 
-        self.stash = cf.stash2standard_name() 
+        self._index = None
+        self._db = None
+        self.identity_cache = {}
+        self.cache_file = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def index(self):
+        """ The compiled common concept index """
+        if self._index is None:
+            self._index = load_concepts(self.jfile, self.index_file)
+        return self._index
+
+    @property
+    def db(self):
+        """ The raw common concept database """
+        if self._db is None:
+            with open(self.jfile,'r') as jdata:
+                self._db = json.load(jdata)
+        return self._db
 
     def _findnn(self, name):
         """ Look for a name in the NCAS common concept table"""
         try:
-            return self.ncasdb['index'][name]
+            return self.index['ncas'][name]
         except KeyError:
             raise NotImplementedError(f'No short name found for [[{name}]]')
 
@@ -100,28 +215,100 @@ class CommonConcepts:
         Find a standard name in the database
         """
         try:
-            return self._dimension_collapse_options(self.db['index'][standard_name])
+            return self.index['standard_names'][standard_name]
         except KeyError:
             return self._findnn(standard_name)
 
+    def signature(self, field):
+        """
+        A cheap signature of everything identify depends on: the standard 
+        (or long) name, the STASH code, the coordinate types, and for
+        single level fields, the Z value (numbers and units, not the string form
+        of the data, which is expensive to make).
+        """
+        name = field.get_property('standard_name', None)
+        if name is None:
+            name = 'long_name=' + str(field.get_property('long_name', None))
+        coordinate_types = [c.ctype for c in field.coordinates().values()]
+        level = None
+        if 'Z' in coordinate_types:
+            zdata = field.coordinate('Z').data
+            if len(zdata) > 1:
+                level = 'levels'
+            else:
+                level = (str(zdata.Units),) + tuple(zdata.array.ravel().tolist())
+        return (name,
+                field.get_property('um_stash_source', None),
+                tuple(sorted(str(c) for c in coordinate_types)),
+                level)
+
+    def load_cache(self, cache_file):
+        """
+        Use (and later save to, see save_cache) a persistent identification
+        cache. Entries made with a different version of the common concept
+        index are ignored.
+        """
+        self.cache_file = cache_file
+        self.identity_cache.update(self._read_cache(cache_file))
+
+    def _read_cache(self, cache_file):
+        """ Read cache entries from file, if any are valid """
+        try:
+            with open(cache_file,'r') as cfile:
+                content = json.load(cfile)
+        except (OSError, ValueError):
+            return {}
+        if content.get('source') != self._cache_source():
+            return {}
+        return {tuple(k[:2])+(tuple(k[2]),tuple(k[3]) if isinstance(k[3], list) else k[3]):v
+                for k,v in content['entries']}
 
-    def _dimension_collapse_options(self, options):
+    def _cache_source(self):
+        """ Identifies the version of the concepts the cache is valid for """
+        source = json.dumps(_index_source(self.jfile), sort_keys=True).encode()
+        return hashlib.md5(source).hexdigest()
+
+    def save_cache(self):
         """ 
-        For a given standard name, there will be multiple possible
-        common concepts. We can leave the issue of table and 
-        cell methods to other bits of code, but here we collapse down 
-        to options with the same dimensionality
+        Save the identification cache (merged with anything another 
+        task has saved in the meantime), if we have a cache file.
         """
-        dimension_view = {}
-        for table,values in options.items():
-            for option, value in values.items():
-                if value['dimensions'] not in dimension_view:
-                    dimension_view[value['dimensions']] = option
-        return dimension_view
+        if self.cache_file is None:
+            return
+        entries = self._read_cache(self.cache_file)
+        entries.update(self.identity_cache)
+        content = {'source': self._cache_source(),
+                   'entries': [[list(k[:2])+[list(k[2]),k[3]],v] for k,v in entries.items()]}
+        tmp = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp,'w') as cfile:
+            json.dump(content, cfile)
+        os.replace(tmp, self.cache_file)
+
+    def cache_stats(self):
+        """ Identification cache hits and misses """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.identity_cache)}
 
     def identify(self, field):
         """
-        Entry point to find common concept name for a field
+        Entry point to find common concept name for a field. Fields with
+        the same signature as one we have seen before get the same answer,
+        without going through the resolution logic again.
+        """
+        key = self.signature(field)
+        try:
+            result = self.identity_cache[key]
+            self.hits += 1
+            return result
+        except KeyError:
+            self.misses += 1
+        result = self._identify(field)
+        if isinstance(result, str):
+            self.identity_cache[key] = result
+        return result
+
+    def _identify(self, field):
+        """
+        Find common concept name for a field
         """
         try:
             sn = field.standard_name
@@ -185,6 +372,12 @@ def working_test():
         r = c.identify(f)
         print(f.standard_name, r)
 if __name__=="__main__":
+    if sys.argv[1:2] == ['compile']:
+        # build step: python common_concept.py compile [json] [index]
+        jfile = (sys.argv[2:3] or [Path(COMMON_CONCEPT_JSONDIR)/'cmip6_common_concept.json'])[0]
+        index_file = (sys.argv[3:4] or [None])[0]
+        compile_concepts(jfile, index_file)
+        sys.exit()
     # test for duplicates
     verify_consistency()
     # test working 
@@ -21,7 +21,51 @@ config_name = "n1280_processing_v1.json"
 # Chunksize is size _before_ compression, and applied to all variables.
 # Your actual chunk size will depend on the shape of the variable and the compressed volume
 
-storage_options = {'compress':4, 'shuffle':True, 'chunksize':1e6}
+# Where the chunking means the data has to be rearranged across pp records, this is done
+# in a buffer in memory if it is smaller than rechunk_memory (bytes), otherwise in a
+# memory-mapped array in rechunk_scratch (None means the system temporary directory).
+# With pp_index, the pp headers are scanned once up front, and each record is read
+# for the buffer straight from the files (falling back to cf if that isn't possible).
+
+# If chunk_profiles are given, the chunk shape for each variable is chosen to suit the
+# typical reads of a named profile: 'timeseries' (all times at a point), 'spatial' (maps)
+# or 'balanced', chosen by variable, then by frequency, then by default.
+# The profile and the estimated chunks touched by each kind of read are recorded in the file.
+
+storage_options = {'compress':4, 'shuffle':True, 'chunksize':1e6,
+                   'rechunk_memory':4e9, 'rechunk_scratch':None, 'pp_index':True,
+                   'chunk_profiles':{'default':'balanced',
+                                     'frequency':{'1hr':'timeseries', '1hrPt':'timeseries',
+                                                  'mon':'spatial'},
+                                     'variables':{}}}
+
+### Processing Configuration
+# Number of worker processes used to write (and compress) fields in parallel within a task,
+# and the total (uncompressed) field bytes which can be in flight across those workers at
+# any one time, so that big 3D fields are not written at the same time.
+# Output files are moved to S3 by upload_threads background threads, while the next
+# field is written, with at most upload_queue files (and upload_pending_bytes bytes)
+# waiting on local disk. Files bigger than upload_part_size bytes are uploaded in parts
+# over upload_parallel concurrent connections. If identify_cache is the path of a (shared)
+# json file, field identifications are remembered there for the benefit of later tasks.
+# If pp_index_file is the path of a (shared) pp header index, built by running
+# "python eg_n1280.py index", tasks take their record locations from that.
+# Each task records the outputs it has finished in a manifest in manifest_dir, so that
+# a rerun only does what is left.
+# With streaming, rather than reading every field of a task at once, the records of each
+# STASH code (or of as many codes as fit in stream_group_bytes of pp data) are copied to
+# scratch files in stream_scratch (default, the rechunk scratch) and read and written one
+# group at a time, which caps the memory a task needs. Peak memory for each output is
+# kept in the manifest either way.
+# The time, CPU, bytes and memory of each stage of each task are written to instrument_dir,
+# use "python instrument.py summary <instrument_dir>" for throughput across a whole run.
+
+processing_options = {'workers':1, 'worker_memory':16e9,
+                      'upload_threads':2, 'upload_queue':4, 'upload_pending_bytes':50e9,
+                      'upload_part_size':64*1024**2, 'upload_parallel':8,
+                      'identify_cache':None, 'pp_index_file':None, 'manifest_dir':'manifests',
+                      'streaming':False, 'stream_group_bytes':None, 'stream_scratch':None,
+                      'instrument_dir':'instrument'}
 
 ### Experiment Configuration
 # Add your own metadata, but note there is a small mandatory list shown below
@@ -59,13 +103,26 @@ for x in ['project','experiment','further_info_url_base','source_id','nominal_re
 origin = '/gws/nopw/j04/hrcm/n1280run'
 
 #
-# names and number of files to aggregate directly
-# what will hapepns is that, for each variable, the values will be aggregated across N files.
+# names and how to group the files to aggregate directly
+# what will hapepns is that, for each variable, the values will be aggregated across a group of files.
+# Groups are calendar aligned: 'month' or 'year' (taken from the pp headers if there is a
+# pp_index_file, otherwise from UM style file names), or you can give a fixed number of files.
 # eg. if you have an output stream with 6 variables output hourly with 48 hours per file, and you
-# enter ('1hrly',15) you will end up with 6 files each with 30 days per file.
-# this obviously works nicely for 360 day calendars, will need to be smarter soon.
+# enter ('1hrly','month') you will end up with 6 files each with one month (30 days) per file.
+# Files left over at the end go into a final (short) group, they are never dropped.
 #
-subdirs = [('1hrly',15),('6hrly',3),('apy',35)]
+subdirs = [('1hrly','month'),('6hrly','month'),('apy',35)]
+
+# Tasks are packed with consecutive whole groups up to a budget of bytes and/or estimated
+# seconds (both None for one group per task), using a rough cost model (see planner.py).
+# With equal_spans, every task takes the same number of groups instead (so the output files
+# cover the same span), sized by the biggest group. Each task carries its estimated cost, and
+# with longest_first the most expensive tasks come first in the slurm array, which helps the
+# array finish sooner.
+task_budget = {'bytes':None, 'seconds':4*3600}
+equal_spans = False
+cost_model = {'seconds_per_byte':1/50e6, 'seconds_per_record':0.005}
+longest_first = True
 simulations = {
         'u-ch330':'r1i1p1f1',
         'u-ck777':'r2i1p1f1', 
@@ -82,30 +139,62 @@ output_location = ''
 
 from pathlib import Path
 import json
+import sys
+from ppindex import PPIndex, build_store
+from planner import describe_files, by_start, plan_tasks
 
 def flist(origin, simulation, subdir):
     ''' Utility function for getting all pp files in a particular directory'''
     path = f'{origin}/{simulation}/{subdir}/'
     return list(Path(path).glob('*.pp'))
 
+def content(summary, files):
+    ''' Summarise what is in a group of files from the pp header index summary '''
+    found = [summary[str(f)] for f in files if str(f) in summary]
+    nbytes = sum(s['bytes'] for s in found)
+    records = sum(s['records'] for s in found)
+    return f'{len(found)}/{len(files)} files indexed, {records} records, {nbytes/1e9:.1f}GB'
+
 if __name__ == "__main__":
 
+    index_file = processing_options['pp_index_file']
+    if sys.argv[1:2] == ['index']:
+        # preprocessing: python eg_n1280.py index [index_file]
+        index_file = (sys.argv[2:3] or [index_file or 'pp_index.npz'])[0]
+        build_store(origin, simulations.keys(), [s[0] for s in subdirs], index_file)
+        sys.exit()
+    index = PPIndex.load(index_file) if index_file and Path(index_file).exists() else None
+    # (summarised once, for all the simulations and subdirs)
+    summary = index.file_summary() if index is not None else None
+
     complete_configuration = {
         'storage_options': storage_options,
+        'processing_options': processing_options,
         'experiment_detail': experiment_detail,
         'output_location': output_location,
         'simulations': simulations,
         'tasks':[]
     }
 
+    tasks = []
     for simulation in simulations.keys():
         for subdir in subdirs:
             files = flist(origin,simulation, subdir[0])
-            nfiles = len(files)
-            for i in range(int(nfiles/subdir[1])):
-                s, f = subdir[1]*i, subdir[1]*(i+1)
-                file_group = files[s:f]
-                complete_configuration['tasks'].append((simulation,[str(f) for f in file_group]))
+            if summary is not None:
+                print(simulation, subdir[0], content(summary, files))
+            # in time order (from the pp headers where we have them), for the calendar grouping
+            planned = plan_tasks(by_start(describe_files(files, summary)), subdir[1],
+                                 budget_bytes=task_budget['bytes'], budget_seconds=task_budget['seconds'],
+                                 cost_model=cost_model, equal_spans=equal_spans)
+            for file_group, cost in planned:
+                tasks.append((simulation, file_group, cost))
+            if planned:
+                print(f"{simulation} {subdir[0]}: {len(files)} files in {len(planned)} tasks, "
+                      f"up to {max(c['seconds'] for g, c in planned):.0f}s each")
+    if longest_first:
+        tasks.sort(key=lambda t: -t[2]['seconds'])
+    complete_configuration['tasks'] = tasks
+    print(f'{len(tasks)} tasks, estimated {sum(t[2]["seconds"] for t in tasks)/3600:.1f} hours in total')
         
     with open(config_name,'w') as f:
         json.dump(complete_configuration,f)
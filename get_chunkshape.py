@@ -1,11 +1,183 @@
 import numpy as np
 import math
+from time import time
 
-def get_chunkshape(shape, volume, word_size=4, logging=False, scale_tol=0.8):
+def divisors(number):
+    """
+    All the divisors of number, in ascending order, as a numpy array
+    """
+    number = int(number)
+    small = np.arange(1, math.isqrt(number)+1)
+    small = small[number % small == 0]
+    return np.unique(np.concatenate([small, number//small]))
+
+
+def solve_chunkshape(shape, volume, word_size=4, fixed=None, max_chunks=None,
+                        tolerance=0.1, logging=False):
+    """
+    Given a shape tuple, and byte size for the elements, find the chunk shape 
+    (made up of divisors of each dimension) which comes closest to
+    the given volume (in bytes), by looking at all the combinations of divisors.
+    Constraints: <fixed> is a dictionary of chunk lengths for specific dimensions
+    (e.g. {0:1} for a time chunk of one, or -1 for the full dimension, 
+    so {1:-1, 2:-1} preserves the full lat/lon plane of a 3D field), and
+    <max_chunks> limits the number of chunks in the file.
+    Amongst the shapes within <tolerance> (fractionally) of the best volume we
+    choose the one which divides the unconstrained dimensions into the
+    most similar numbers of pieces.
+    """
+    shape = np.asarray(shape, dtype=np.int64)
+    fixed = fixed or {}
+    target = np.log(volume/word_size)
+    options = []
+    for i, d in enumerate(shape):
+        if i in fixed:
+            length = d if fixed[i] == -1 else fixed[i]
+            if d % length != 0:
+                raise ValueError(f'Fixed chunk length {length} does not divide dimension {i} ({d})')
+            options.append(np.array([length]))
+        else:
+            options.append(divisors(d))
+
+    # build the log volume and balance for every combination by broadcasting
+    ndim = shape.size
+    logvol = np.zeros([len(o) for o in options])
+    logn = []
+    for i, o in enumerate(options):
+        view = [1]*ndim
+        view[i] = len(o)
+        logd = np.log(o).reshape(view)
+        logvol = logvol + logd
+        if i not in fixed:
+            logn.append(np.log(shape[i]) - logd)
+    error = np.abs(logvol - target)
+    if max_chunks is not None:
+        error = np.where(np.log(np.prod(shape.astype(float))) - logvol <= np.log(max_chunks) + 1e-9,
+                         error, np.inf)
+    best = error.min()
+    if not np.isfinite(best):
+        raise ValueError(f'No chunk shape for {shape} gives at most {max_chunks} chunks')
+    if logn:
+        logn = np.broadcast_arrays(*logn)
+        imbalance = np.std(np.stack(logn), axis=0)
+    else:
+        imbalance = np.zeros(logvol.shape)
+    candidates = error <= best + np.log1p(tolerance)
+    choice = np.unravel_index(np.argmin(np.where(candidates, imbalance, np.inf)), logvol.shape)
+    results = [int(o[i]) for o, i in zip(options, choice)]
+
+    if logging:
+        actual_n_chunks = int(np.prod(np.divide(shape,np.array(results))))
+        cvolume = int(np.prod(np.array(results)) * word_size)
+        print(f'Chunk size {results} - wanted {int(volume)}B will get {actual_n_chunks}/{cvolume}B')
+    return results
+
+
+def get_chunkshape(shape, volume, word_size=4, logging=False, scale_tol=0.8, **constraints):
     """
     Given a shape tuple, and byte size for the elements, calculate a suitable chunk shape
     for a given volume (in bytes). (We use word instead of dtype in case the user
     changes the data type within the writing operation.)
+    Now uses solve_chunkshape (which can take constraints), scale_tol
+    is retained for compatibility but is no longer used.
+    """
+    return solve_chunkshape(shape, volume, word_size=word_size, logging=logging, **constraints)
+
+
+# Named chunking profiles, as weights on the (log) number of chunks touched by
+# typical queries: a point time series (all times at one point and level), a map
+# (all of the horizontal at one time and level), and, for fields with levels,
+# a profile (all levels at one point and time).
+CHUNK_PROFILES = {
+    'timeseries': {'timeseries':1.0, 'map':0.1, 'profile':0.1},
+    'spatial':    {'timeseries':0.1, 'map':1.0, 'profile':0.1},
+    'balanced':   {'timeseries':1.0, 'map':1.0, 'profile':0.5},
+}
+QUERY_AXES = {'timeseries':('T',), 'map':('Y','X'), 'profile':('Z',)}
+
+
+def _queries(axes):
+    """ The typical queries which make sense for data with these axes types """
+    return {q:a for q,a in QUERY_AXES.items() if all(x in axes for x in a)}
+
+
+def estimate_read_cost(shape, chunks, axes):
+    """
+    Estimate the cost of each typical query (see CHUNK_PROFILES) as the number
+    of chunks it touches, for data of <shape> with <chunks>, where <axes> gives
+    the type of each dimension ('T','Z','Y','X' or anything else).
+    """
+    costs = {}
+    for query, qaxes in _queries(axes).items():
+        n = 1
+        for d, c, a in zip(shape, chunks, axes):
+            if a in qaxes:
+                n *= math.ceil(d/c)
+        costs[query] = int(n)
+    return costs
+
+
+def profile_chunkshape(shape, axes, volume, profile, word_size=4, band=1.25, logging=False):
+    """
+    Find the chunk shape (made up of divisors of each dimension) with a volume
+    within a factor of <band> of the given <volume> (in bytes) which minimises 
+    the read cost of the typical queries, weighted according to the named 
+    <profile> (see CHUNK_PROFILES). <axes> gives the type of each dimension 
+    ('T','Z','Y','X' or anything else). If nothing is in the band, we fall back 
+    to solve_chunkshape.
+    """
+    weights = CHUNK_PROFILES[profile]
+    queries = _queries(axes)
+    shape = np.asarray(shape, dtype=np.int64)
+    options = [divisors(d) for d in shape]
+    ndim = shape.size
+    logvol = np.zeros([len(o) for o in options])
+    cost = np.zeros(logvol.shape)
+    for i, o in enumerate(options):
+        view = [1]*ndim
+        view[i] = len(o)
+        logd = np.log(o).reshape(view)
+        logvol = logvol + logd
+        for query, qaxes in queries.items():
+            if axes[i] in qaxes:
+                cost = cost + weights[query]*(np.log(shape[i]) - logd)
+    error = np.abs(logvol - np.log(volume/word_size))
+    inband = error <= np.log(band)
+    if not inband.any():
+        return solve_chunkshape(shape, volume, word_size=word_size, logging=logging)
+    # break ties in favour of the volume closest to that requested
+    choice = np.unravel_index(np.argmin(np.where(inband, cost + 1e-6*error, np.inf)), logvol.shape)
+    results = [int(o[i]) for o, i in zip(options, choice)]
+    if logging:
+        costs = estimate_read_cost(shape, results, axes)
+        cvolume = int(np.prod(np.array(results)) * word_size)
+        print(f'Chunk size {results} ({cvolume}B) for {profile} profile, chunks touched {costs}')
+    return results
+
+
+def choose_profile(storage_options, variable, frequency):
+    """
+    Choose the chunking profile for a variable (common concept name) at a given
+    frequency from the chunk_profiles in the storage_options, which look like
+    {'default':'balanced', 'frequency':{'1hr':'timeseries'}, 'variables':{'tas':'timeseries'}}
+    (a variable setting beats a frequency setting beats the default).
+    Returns None if there are no chunk_profiles.
+    """
+    profiles = storage_options.get('chunk_profiles', None)
+    if not profiles:
+        return None
+    profile = profiles.get('variables', {}).get(variable,
+                profiles.get('frequency', {}).get(frequency,
+                    profiles.get('default', 'balanced')))
+    if profile not in CHUNK_PROFILES:
+        raise ValueError(f'Unknown chunk profile {profile} (choose from {list(CHUNK_PROFILES)})')
+    return profile
+
+
+def greedy_chunkshape(shape, volume, word_size=4, logging=False, scale_tol=0.8):
+    """
+    The original get_chunkshape, which tunes the dimensions greedily one by one.
+    Retained for comparison.
     """
 
     def constrained_largest_divisor(number, constraint):
@@ -103,9 +275,57 @@ def test_n1280b( volume = 1e6, logging=True):
     size = np.prod(np.array(result)) * 4 
 
 
+def test_constraints(volume = 1e6, logging=True):
+    shape = np.array([720, 1920, 2560])
+    result = get_chunkshape(shape, volume, fixed={0:1}, logging=logging)
+    assert result[0] == 1
+    result = get_chunkshape(shape, volume, fixed={1:-1, 2:-1}, logging=logging)
+    assert result[1:] == [1920, 2560]
+    result = get_chunkshape(shape, volume, max_chunks=100, logging=logging)
+    assert np.prod(shape)/np.prod(result) <= 100
+
+def test_closeness(volume = 1e6, tolerance=0.1):
+    """ 
+    The solver should never be further from the target than the greedy method
+    (give or take the tolerance it uses to prefer balanced shapes)
+    """
+    for shape in ([720, 1920, 2560], [719, 1920, 2560], [360, 85, 1920, 2560], [8640, 85, 1920, 2560]):
+        shape = np.array(shape)
+        new = np.prod(get_chunkshape(shape, volume, tolerance=tolerance))*4
+        old = np.prod(greedy_chunkshape(shape, volume))*4
+        assert abs(np.log(new/volume)) <= abs(np.log(old/volume)) + np.log1p(tolerance)
+
+def test_speed(volume = 1e6, limit=0.1):
+    e1 = time()
+    get_chunkshape(np.array([8640, 85, 1920, 2560]), volume)
+    e2 = time()
+    assert e2-e1 < limit, f'4D chunk shape took {e2-e1:.3f}s'
+
+def test_profiles(volume = 1e6, logging=True):
+    shape = np.array([720, 1920, 2560])
+    axes = ['T', 'Y', 'X']
+    costs = {}
+    for profile in CHUNK_PROFILES:
+        result = profile_chunkshape(shape, axes, volume, profile, logging=logging)
+        for x,y in zip(shape, result):
+            assert x%y == 0
+        costs[profile] = estimate_read_cost(shape, result, axes)
+    assert costs['timeseries']['timeseries'] < costs['balanced']['timeseries'] <= costs['spatial']['timeseries']
+    assert costs['spatial']['map'] < costs['balanced']['map'] <= costs['timeseries']['map']
+    options = {'chunk_profiles':{'default':'balanced', 'frequency':{'1hr':'timeseries'}, 'variables':{'psl':'spatial'}}}
+    assert choose_profile(options, 'tas', '1hr') == 'timeseries'
+    assert choose_profile(options, 'psl', '1hr') == 'spatial'
+    assert choose_profile(options, 'tas', 'mon') == 'balanced'
+    assert choose_profile({}, 'tas', 'mon') is None
+
+
 if __name__ == "__main__":
     test_n1280(1e6)
     test_n1280(2e6)
     test_n1280(4e6)
     test_n1280b(2e6)
+    test_constraints()
+    test_closeness()
+    test_speed()
+    test_profiles()
     
@@ -0,0 +1,221 @@
+import json
+import os
+import sys
+import threading
+from collections import defaultdict
+from pathlib import Path
+from time import time, process_time, thread_time
+
+# The stages of a conversion task, in order
+SPANS = ('read', 'identify', 'chunk-plan', 'temp-write', 'final-write', 'upload')
+
+
+def reset_peak_rss():
+    """ Start measuring peak memory afresh (Linux only), returning False if we can't """
+    try:
+        with open('/proc/self/clear_refs', 'w') as refs:
+            refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """ Peak resident memory (bytes) of this process since it started or was reset, or None """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class Span:
+    """
+    Measure one named stage of the work, as a context manager: wall and CPU
+    time, bytes in and out (which can be set as we learn them), and the peak
+    memory of the process during the span. Spans in background threads should
+    use thread CPU time and not measure peak memory (resetting it would spoil
+    the measurement of whatever the main thread is doing). Labels (e.g. the
+    variable and frequency) are kept with the measurements, and if we have an
+    instrument, the finished span is recorded there.
+    """
+    def __init__(self, name, instrument=None, bytes_in=0, bytes_out=0,
+                 thread=False, measure_peak=True, **labels):
+        self.name = name
+        self.instrument = instrument
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.clock = thread_time if thread else process_time
+        self.measure_peak = measure_peak and not thread
+        self.labels = labels
+        self.record = None
+
+    def __enter__(self):
+        if self.measure_peak:
+            reset_peak_rss()
+        self.started = time()
+        self.cpu = self.clock()
+        return self
+
+    def __exit__(self, etype, value, tb):
+        self.record = {'span': self.name, 'start': self.started,
+                       'wall': time() - self.started, 'cpu': self.clock() - self.cpu,
+                       'bytes_in': int(self.bytes_in), 'bytes_out': int(self.bytes_out),
+                       'peak_rss': peak_rss() if self.measure_peak else None,
+                       'pid': os.getpid(), **self.labels}
+        if etype is not None:
+            self.record['error'] = etype.__name__
+        if self.instrument is not None:
+            self.instrument.add(self.record)
+        return False
+
+
+class Instrument:
+    """
+    The spans of a task, kept in memory and (if we have a path) written as
+    json lines as they finish, with the context of the task (e.g. the task
+    number) added to each.
+    """
+    def __init__(self, path=None, **context):
+        self.path = None if path is None else Path(path)
+        self.context = context
+        self.records = []
+        self.lock = threading.Lock()
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def for_task(cls, directory, task_number, **context):
+        return cls(Path(directory)/f'task-{task_number:06d}.jsonl', task=task_number, **context)
+
+    def span(self, name, **kwargs):
+        """ A span which will be recorded here when it finishes """
+        return Span(name, instrument=self, **kwargs)
+
+    def add(self, record):
+        """ Record a finished span (which may have been measured elsewhere) """
+        record = {**self.context, **record}
+        with self.lock:
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, 'a') as ifile:
+                    ifile.write(json.dumps(record)+'\n')
+
+    def totals(self, name):
+        """ Number, wall seconds, bytes in and out of the spans called name so far """
+        chosen = [r for r in self.records if r['span'] == name]
+        return (len(chosen), sum(r['wall'] for r in chosen),
+                sum(r['bytes_in'] for r in chosen), sum(r['bytes_out'] for r in chosen))
+
+
+def load_records(paths):
+    """ All the span records in paths (json lines files, or directories of them) """
+    records = []
+    for path in paths:
+        path = Path(path)
+        for f in sorted(path.glob('*.jsonl')) if path.is_dir() else [path]:
+            with open(f) as ifile:
+                for line in ifile:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+    return records
+
+
+def rollup(records, by=()):
+    """
+    Roll up span records by span name and the labels in by (e.g. ('frequency',)),
+    giving a dictionary of key to count, wall and CPU seconds, bytes in and out,
+    throughput (MB/s of bytes in) and largest peak memory.
+    """
+    table = defaultdict(lambda: {'n': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes_in': 0, 'bytes_out': 0,
+                                 'peak_rss': None, 'errors': 0})
+    for r in records:
+        key = tuple(r.get(b) for b in by) + (r['span'],)
+        row = table[key]
+        row['n'] += 1
+        for k in ('wall', 'cpu', 'bytes_in', 'bytes_out'):
+            row[k] += r.get(k) or 0
+        if r.get('peak_rss') is not None:
+            row['peak_rss'] = max(row['peak_rss'] or 0, r['peak_rss'])
+        row['errors'] += 'error' in r
+    for row in table.values():
+        row['rate'] = row['bytes_in']/1e6/row['wall'] if row['wall'] > 0 else None
+    order = {s: i for i, s in enumerate(SPANS)}
+    return dict(sorted(table.items(),
+                key=lambda kv: tuple(str(k) for k in kv[0][:-1]) + (order.get(kv[0][-1], len(SPANS)), kv[0][-1])))
+
+
+def format_rollup(table, by=()):
+    """ A rollup as lines of text """
+    heading = [b.capitalize() for b in by] + ['Span']
+    rows = []
+    for key, row in table.items():
+        rows.append([str(k) for k in key] + [
+            str(row['n']), f"{row['wall']:.1f}", f"{row['cpu']:.1f}",
+            f"{row['bytes_in']/1e6:.1f}", f"{row['bytes_out']/1e6:.1f}",
+            '-' if row['rate'] is None else f"{row['rate']:.1f}",
+            '-' if row['peak_rss'] is None else f"{row['peak_rss']/1e9:.2f}",
+            str(row['errors'])])
+    heading += ['N', 'Wall(s)', 'CPU(s)', 'In(MB)', 'Out(MB)', 'MB/s', 'Peak(GB)', 'Errors']
+    widths = [max(len(r[i]) for r in rows + [heading]) for i in range(len(heading))]
+    nlabels = len(by) + 1
+    return [' '.join(c.ljust(w) if i < nlabels else c.rjust(w)
+                     for i, (c, w) in enumerate(zip(r, widths))) for r in [heading] + rows]
+
+
+def summarise(paths):
+    """ Print throughput tables (overall, per frequency and per variable) for a run """
+    records = load_records(paths)
+    tasks = {r.get('task') for r in records}
+    print(f'{len(records)} spans from {len(tasks)} tasks')
+    for by in ((), ('frequency',), ('variable',)):
+        chosen = records if not by else [r for r in records if r.get(by[0]) is not None]
+        print()
+        for line in format_rollup(rollup(chosen, by), by):
+            print(line)
+
+
+def test_instrument():
+    """ Record some spans, reload and roll them up """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        instrument = Instrument.for_task(tmp, 7, simulation='sim')
+        with instrument.span('read', bytes_in=100):
+            sum(range(10000))
+        for variable, frequency in (('tas', '1hr'), ('pr', '1hr'), ('ua', 'day')):
+            with instrument.span('final-write', bytes_in=1e6, frequency=frequency) as span:
+                span.bytes_out = 5e5
+                span.labels['variable'] = variable
+        try:
+            with instrument.span('upload', thread=True, frequency='day', variable='ua'):
+                raise OSError('no network')
+        except OSError:
+            pass
+        # measured elsewhere (e.g. a worker process)
+        with Span('temp-write', bytes_in=10) as span:
+            pass
+        instrument.add(dict(span.record, variable='ua', frequency='day'))
+        assert instrument.totals('final-write')[0] == 3
+        records = load_records([tmp])
+        assert len(records) == 6 and all(r['task'] == 7 and r['simulation'] == 'sim' for r in records)
+        assert records[-2]['error'] == 'OSError' and records[-2]['peak_rss'] is None
+        overall = rollup(records)
+        assert list(overall)[:3] == [('read',), ('temp-write',), ('final-write',)]
+        assert overall[('final-write',)]['bytes_out'] == 1.5e6
+        by_frequency = rollup(records, ('frequency',))
+        assert by_frequency[('1hr', 'final-write')]['n'] == 2
+        assert by_frequency[('day', 'upload')]['errors'] == 1
+        assert len(format_rollup(by_frequency, ('frequency',))) == len(by_frequency) + 1
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['summary']:
+        # python instrument.py summary instrument_dir [more dirs or files]
+        summarise(sys.argv[2:] or ['instrument'])
+        sys.exit()
+    test_instrument()
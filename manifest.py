@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from time import time
+
+
+def file_sha256(path, blocksize=16*1024**2):
+    """ The sha256 of a (local) file """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """
+    A record (json lines) of the outputs a task has finished: each output is
+    recorded when it is written (filename, size, sha256), and again when it has been
+    uploaded (with the object name and etag), so that a rerun of the task can
+    skip outputs which are already complete.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if self.path.exists():
+            with open(self.path) as mfile:
+                for line in mfile:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.entries[entry['filename']] = entry
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def for_task(cls, directory, task_number):
+        return cls(Path(directory)/f'task-{task_number:06d}.jsonl')
+
+    def _add(self, entry):
+        entry['time'] = time()
+        with self.lock:
+            self.entries[entry['filename']] = entry
+            with open(self.path, 'a') as mfile:
+                mfile.write(json.dumps(entry)+'\n')
+
+    def written(self, filename, checksum=True, **extra):
+        """ 
+        Record that filename has been written (with its checksum, unless we're
+        going to get that from the upload anyway, and anything extra we want to keep)
+        """
+        self._add({'filename': str(filename), 'state': 'written', 'size': os.path.getsize(filename),
+                   'sha256': file_sha256(filename) if checksum else None, **extra})
+
+    def uploaded(self, filename, object_name, size, hashes):
+        """
+        Record that filename has been uploaded, with the hashes from the upload
+        (and the etag the object has now, which differs after a metadata copy)
+        """
+        self._add({'filename': str(filename), 'state': 'uploaded', 'object': object_name, 'size': size,
+                   'sha256': hashes.get('sha256'), 'etag': hashes.get('object_etag', hashes.get('etag'))})
+
+    def group_done(self, key, outputs):
+        """ Record that everything read for a group (e.g. of STASH codes) made outputs """
+        self._add({'filename': key, 'state': 'group', 'outputs': [str(o) for o in outputs]})
+
+    def group_outputs(self, key):
+        """ The outputs made from a group, if it was finished, otherwise None """
+        entry = self.entries.get(key)
+        if entry is None or entry['state'] != 'group':
+            return None
+        return entry['outputs']
+
+    def needs_listing(self):
+        """ Are there any uploads we could check against the bucket? """
+        return any(e['state'] == 'uploaded' for e in self.entries.values())
+
+    def uploaded_objects(self):
+        """ The object names of the uploads recorded here (the only ones we need to check) """
+        return [e['object'] for e in self.entries.values() if e['state'] == 'uploaded']
+
+    def status(self, filename, objects=None):
+        """
+        Is filename finished? Returns 'uploaded' if the manifest says so and the
+        object is in objects (a dictionary of object name to (size, etag) from a
+        listing) with the same size and etag, 'written' if the manifest says it
+        was written and the local file is still there with the same size,
+        otherwise None.
+        """
+        entry = self.entries.get(str(filename))
+        if entry is None:
+            return None
+        if entry['state'] == 'uploaded' and objects is not None:
+            found = objects.get(entry['object'])
+            if found is not None and found[0] == entry['size'] and found[1] == entry['etag']:
+                return 'uploaded'
+        if os.path.exists(filename) and os.path.getsize(filename) == entry['size']:
+            return 'written'
+        return None
+
+
+def list_outputs(client, bucket, names):
+    """
+    Find which of the object names are in the bucket, giving a dictionary of
+    object name to (size, etag). We make one (non-recursive) listing for each
+    directory the names are in, under the prefix the names there share, and
+    match the names against it, rather than ask about each name in turn.
+    """
+    directories = {}
+    for name in set(names):
+        directories.setdefault(name.rpartition('/')[0], []).append(name)
+    found = {}
+    for directory, wanted in directories.items():
+        prefix = os.path.commonprefix(wanted)
+        wanted = set(wanted)
+        for o in client.list_objects(bucket, prefix=prefix, recursive=False):
+            if o.object_name in wanted:
+                found[o.object_name] = (o.size, o.etag.strip('"') if o.etag else None)
+    return found
+
+
+def test_manifest():
+    """ Record outputs, reload, and check what counts as finished """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        a, b, c = (os.path.join(tmp, f'{x}.nc') for x in 'abc')
+        for name in (a, b, c):
+            with open(name, 'wb') as f:
+                f.write(b'data')
+        manifest = Manifest.for_task(tmp, 3)
+        manifest.written(a)
+        manifest.written(b)
+        manifest.uploaded(b, 'b', 4, {'sha256': 'x', 'etag': 'e1'})
+        os.remove(b)
+        again = Manifest.for_task(tmp, 3)
+        assert again.entries[a]['sha256'] == hashlib.sha256(b'data').hexdigest()
+        assert again.needs_listing()
+        assert again.status(a) == 'written'
+        assert again.status(b, {'b': (4, 'e1')}) == 'uploaded'
+        assert again.status(b, {'b': (4, 'e2')}) is None
+        assert again.status(b, {}) is None
+        assert again.status(c) is None
+        assert again.group_outputs('stash:1:3236') is None
+        again.group_done('stash:1:3236', [a, c])
+        assert Manifest.for_task(tmp, 3).group_outputs('stash:1:3236') == [a, c]
+        assert again.uploaded_objects() == ['b']
+        with open(a, 'ab') as f:
+            f.write(b'more')
+        assert again.status(a) is None
+
+
+def test_list_outputs():
+    """ One listing per directory of the names, and nothing else """
+    class Object:
+        def __init__(self, name):
+            self.object_name, self.size, self.etag = name, 4, f'"{name}"'
+
+    class Client:
+        bucket = ['tas_1hr.nc', 'pr_1hr.nc', 'ua_day.nc', 'sim/ua_1hr.nc', 'sim/va_1hr.nc', 'sim/old/ua_1hr.nc']
+        listings = []
+        def list_objects(self, bucket, prefix='', recursive=False):
+            self.listings.append(prefix)
+            for name in self.bucket:
+                if name.startswith(prefix) and (recursive or '/' not in name[len(prefix):]):
+                    yield Object(name)
+        def stat_object(self, bucket, name):
+            raise AssertionError('should not need a HEAD per object')
+
+    client = Client()
+    found = list_outputs(client, 'b', ['tas_1hr.nc', 'ua_day.nc', 'zg_day.nc', 'sim/ua_1hr.nc', 'sim/va_1hr.nc'])
+    assert found == {n: (4, n) for n in ['tas_1hr.nc', 'ua_day.nc', 'sim/ua_1hr.nc', 'sim/va_1hr.nc']}
+    assert sorted(client.listings) == ['', 'sim/']
+    assert list_outputs(client, 'b', []) == {}
+
+
+if __name__ == "__main__":
+    test_manifest()
+    test_list_outputs()
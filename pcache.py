@@ -0,0 +1,197 @@
+import pickle
+import os
+import socket
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+
+
+class PrefixCache:
+    """
+    An in-process tree of what we know about the objects in one bucket. For
+    each "directory" prefix we keep the files in it (name -> (size, last_modified))
+    and its sub-directories. The tree is filled from recursive listings, and
+    a prefix is only served from the cache if it lies under a listing which is
+    less than ttl seconds old. If we hold more than max_objects, the least
+    recently used listings are evicted. Changes we make ourselves can be
+    applied with add and remove, so that we don't need to list again.
+    """
+    def __init__(self, ttl=600, max_objects=2_000_000):
+        self.ttl = ttl
+        self.max_objects = max_objects
+        self.nodes = {}
+        # listing root -> time listed, least recently used first
+        self.listings = OrderedDict()
+        self.nobjects = 0
+
+    def _node(self, prefix):
+        """ Get (or make) the node for a prefix """
+        node = self.nodes.get(prefix)
+        if node is None:
+            node = self.nodes[prefix] = {'files':{}, 'dirs':set()}
+        return node
+
+    def add(self, name, size, last_modified):
+        """
+        Add (or update) an object
+        """
+        parts = name.split('/')
+        prefix = ''
+        for part in parts[:-1]:
+            child = f'{prefix}{part}/'
+            self._node(prefix)['dirs'].add(child)
+            prefix = child
+        files = self._node(prefix)['files']
+        if name not in files:
+            self.nobjects += 1
+        files[name] = (size, last_modified)
+
+    def remove(self, name):
+        """
+        Remove an object, and any directories which are left empty
+        """
+        prefix = name[:name.rfind('/')+1]
+        node = self.nodes.get(prefix)
+        if node is None or name not in node['files']:
+            return
+        del node['files'][name]
+        self.nobjects -= 1
+        while prefix != '' and not node['files'] and not node['dirs']:
+            del self.nodes[prefix]
+            parent = prefix[:prefix[:-1].rfind('/')+1]
+            node = self.nodes.get(parent)
+            if node is None:
+                break
+            node['dirs'].discard(prefix)
+            prefix = parent
+
+    def load(self, root, objects):
+        """
+        Fill the cache from a recursive listing (of objects) of everything below root
+        """
+        for listed in [r for r in self.listings if r.startswith(root)]:
+            self.drop(listed)
+        for o in objects:
+            self.add(o.object_name, o.size, o.last_modified)
+        self._node(root)
+        self.listings[root] = time()
+        while self.nobjects > self.max_objects and len(self.listings) > 1:
+            self.drop(next(iter(self.listings)))
+
+    def drop(self, root):
+        """
+        Forget the listing at root, and everything below it
+        """
+        self.listings.pop(root, None)
+        for prefix in [p for p in self.nodes if p.startswith(root)]:
+            self.nobjects -= len(self.nodes[prefix]['files'])
+            del self.nodes[prefix]
+        if root != '':
+            parent = self.nodes.get(root[:root[:-1].rfind('/')+1])
+            if parent is not None:
+                parent['dirs'].discard(root)
+
+    def covering(self, prefix):
+        """
+        Return the root of a fresh listing which covers prefix (and mark it
+        as recently used), or None if we need to list again.
+        """
+        now = time()
+        for root, listed in list(self.listings.items()):
+            if now - listed > self.ttl:
+                self.drop(root)
+            elif prefix.startswith(root):
+                self.listings.move_to_end(root)
+                return root
+        return None
+
+    def summary(self, path, match=None):
+        """
+        Summarise what is below path, in the same form as
+        PsuedoFileSystem._recurse: total bytes and objects, number of directories,
+        the immediate sub-directories with their total bytes, and the files
+        at this level (as [name, size, last_modified]), optionally only
+        counting objects which match a (pathlib) pattern.
+        """
+        def walk(prefix):
+            """ total bytes and objects below prefix, and count directories """
+            node = self.nodes.get(prefix)
+            if node is None:
+                return 0, 0, 0
+            total, count, dirs = 0, 0, 1
+            for name, (size, date) in node['files'].items():
+                if match is None or Path(name).match(match):
+                    total += size
+                    count += 1
+            for child in node['dirs']:
+                t, c, d = walk(child)
+                total += t
+                count += c
+                dirs += d
+            return total, count, dirs
+
+        node = self.nodes.get(path, {'files':{}, 'dirs':set()})
+        myfiles = [[name, size, date] for name, (size, date) in sorted(node['files'].items())
+                    if match is None or Path(name).match(match)]
+        total = sum(f[1] for f in myfiles)
+        count = len(myfiles)
+        dirs = 1
+        mydirs = []
+        for child in sorted(node['dirs']):
+            t, c, d = walk(child)
+            total += t
+            count += c
+            dirs += d
+            mydirs.append([child, t])
+        return total, count, dirs, mydirs, myfiles
+
+    def save(self, snapshot):
+        """
+        Save a snapshot of the cache to disk
+        """
+        snapshot = Path(snapshot)
+        snapshot.parent.mkdir(parents=True, exist_ok=True)
+        # another session may be saving a snapshot of the same bucket, so each writes its own file
+        tmp = f'{snapshot}.{socket.gethostname()}.{os.getpid()}.tmp'
+        with open(tmp,'wb') as sfile:
+            pickle.dump((self.listings, self.nodes, self.nobjects), sfile, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, snapshot)
+
+    def restore(self, snapshot):
+        """
+        Restore the cache from a snapshot (if there is one), stale listings
+        will be dropped as usual when they are next needed.
+        """
+        try:
+            with open(snapshot,'rb') as sfile:
+                self.listings, self.nodes, self.nobjects = pickle.load(sfile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+
+
+def test_cache():
+    """
+    Test adding, summarising, removing and eviction
+    """
+    class O:
+        def __init__(self, name, size):
+            self.object_name, self.size, self.last_modified = name, size, None
+    cache = PrefixCache(max_objects=5)
+    cache.load('', [O('a.nc', 1), O('d1/b.nc', 2), O('d1/sub/c.nc', 4), O('d2/d.txt', 8)])
+    assert cache.covering('d1/sub/') == ''
+    total, count, dirs, mydirs, myfiles = cache.summary('')
+    assert (total, count, dirs) == (15, 4, 4)
+    assert mydirs == [['d1/', 6], ['d2/', 8]]
+    assert cache.summary('d1/', '*.nc')[0:2] == (6, 2)
+    cache.remove('d1/sub/c.nc')
+    assert 'd1/sub/' not in cache.nodes
+    assert cache.summary('d1/')[0:3] == (2, 1, 1)
+    cache.add('d3/e.nc', 16, None)
+    assert cache.summary('')[0:2] == (27, 4)
+    cache.ttl = -1
+    assert cache.covering('') is None
+    assert cache.nobjects == 0
+
+
+if __name__ == "__main__":
+    test_cache()
@@ -1,9 +1,15 @@
+import hashlib
 import click
 from skin import _i, _e, _p
-from s3core import get_client, lswild
-from minio.deleteobjects import DeleteObject
+from s3core import get_client, lswild, bucket_made
 from pathlib import Path
-from minio.commonconfig import CopySource
+from datetime import datetime, timezone
+from pcache import PrefixCache
+from s3move import move_objects
+from s3delete import DeleteStats, bulk_delete, default_report
+
+# Where we keep snapshots of the listing caches
+SNAPSHOT_DIR = Path.home()/'.cache'/'pp2nice'
 
 def fmt_size(num, suffix="B"):
     """ Take the sizes and humanize them """
@@ -17,26 +23,42 @@ def fmt_date(adate):
     """ Take the reported date and humanize it"""
     return adate.strftime('%Y-%m-%d %H:%M:%S %Z')
 
-def rm(client, bucket, objects):
+def rm(client, bucket, listing, dry_run=False, threads=4, report=None):
      """ 
-     Remove a list of objects 
+     Remove the objects from listing (a function giving a fresh listing, e.g.
+     from lswild), showing a summary of what will go rather than every name.
+     Once confirmed, the objects are streamed from a second pass over the
+     listing straight into concurrent batches of deletes (see s3delete.bulk_delete),
+     so we never hold the whole listing (anything newer than the summary is left
+     alone). Any errors are written to a report file. Returns the names of those
+     deleted (none if a dry_run).
      """
-     click.echo(_i('\nList of objects for deletion:'))
-     for o in objects:
-         click.echo(_e(o.object_name))
-     if click.confirm(_p('Delete these files from {bucket}?'), default=False):
-        delete_list = [DeleteObject(o.object_name) for o in objects]
-        # this would be lazy if I didn't force it with the list and error parsing
-        errors = list(client.remove_objects( bucket, delete_list))
-        if errors != []:
-            for error in errors:
-                print("error occurred when deleting object", error)
-            lf = len(objects)
-            le = len(errors)
-            click.echo(_p(f"{lf-le}/{lf} files deleted from {bucket} in {client.alias_name}"))
-            click.echo(_p('You will need to check which files were actually deleted'))
+     stats = DeleteStats()
+     newest = None
+     for o in listing():
+         stats.add(o.object_name, o.size)
+         if o.last_modified is not None:
+             newest = o.last_modified if newest is None else max(newest, o.last_modified)
+     if stats.count == 0:
+         click.echo(_i(f'Nothing to delete found in [{bucket}] in [{client.alias_name}]'))
+         return []
+     click.echo(_i('\nObjects for deletion:'))
+     for line in stats.report(fmt_size):
+         click.echo(_e(line))
+     if dry_run:
+         click.echo(_i('Dry run, nothing deleted'))
+         return []
+     if click.confirm(_p(f'Delete these files from {bucket}?'), default=False):
+        items = ((o.object_name, o.size) for o in listing()
+                 if newest is None or o.last_modified is None or o.last_modified <= newest)
+        result = bulk_delete(client, bucket, items, threads=threads, report=report or default_report(bucket))
+        if result['failed']:
+            click.echo(_p(f"{result['ndeleted']}/{stats.count} files deleted from {bucket} in {client.alias_name}"))
+            click.echo(_p(f"Errors for {result['failed']} files are in {result['report']}"))
         else:
-            click.echo(_i(f"{len(objects)} objects deleted from {bucket} in {client.alias_name}"))
+            click.echo(_i(f"{result['ndeleted']} objects ({fmt_size(result['bytes'])}) deleted from {bucket} in {client.alias_name} in {result['seconds']:.1f}s"))
+        return result['deleted']
+     return []
 
 
         
@@ -46,13 +68,24 @@ class PsuedoFileSystem:
     """
     Provides a limited shell for working with S3 buckets as if they were a posix like file system
     """
-    def __init__(self, alias, bucket, cwd):
+    def __init__(self, alias, bucket, cwd, max_depth=None, ttl=600, max_objects=2_000_000, snapshot=True, threads=8):
         """
-        Can be instantiated with just a minio alias, or a specific bucket, or even a specific working directory in that bucket
+        Can be instantiated with just a minio alias, or a specific bucket, or even a specific working directory in that bucket.
+        What we list is kept in a cache (see PrefixCache) for ttl seconds (up to max_objects), and if snapshot is True
+        the cache is saved to disk, so that we can start again from where we left off.
+        Alternatively, if max_depth is given, we don't cache objects, but directory sizes are summed to at most max_depth 
+        levels below where we list from. Moves and deletes use up to threads concurrent requests.
         """
         click.echo(_i('You have entered a lightweight management tool for organising "files" inside an S3 object store'))
         self.client = get_client(alias)
         self.alias = alias
+        self.max_depth = max_depth
+        self.ttl = ttl
+        self.max_objects = max_objects
+        self.snapshot = snapshot
+        self.threads = threads
+        self.caches = {}
+        self._forget()
         self.buckets = [b.name for b in self.client.list_buckets()]
         if bucket is None or cwd is None:
             self.cb(bucket)
@@ -64,37 +97,133 @@ class PsuedoFileSystem:
             self.cd(cwd)
         self.path = ''
 
+    def _forget(self):
+        """
+        Forget what we know about the sizes of things
+        """
+        # prefix -> [bytes, objects], and the prefixes we have scanned
+        # below (with the depth to which the scan was summed)
+        self.usage = {}
+        self.scanned = {}
+
+    def _scan(self, path, match=None):
+        """
+        One pass over a recursive listing of everything below path, summing
+        bytes and object counts for every prefix (down to max_depth levels), 
+        and keeping the details of files at the top level only. 
+        Returns the sums and the files.
+        """
+        prefix = path if path != "" else None
+        usage = {}
+        myfiles = []
+        for o in self.client.list_objects(self.bucket, prefix=prefix, recursive=True):
+            if match is not None and not Path(o.object_name).match(match):
+                continue
+            rest = o.object_name[len(path):].split('/')
+            if len(rest) == 1:
+                myfiles.append([o.object_name, fmt_size(o.size), fmt_date(o.last_modified)])
+            depth = len(rest)-1
+            if self.max_depth is not None:
+                depth = min(depth, self.max_depth)
+            p = path
+            for level in range(depth+1):
+                if level:
+                    p = f'{p}{rest[level-1]}/'
+                u = usage.setdefault(p, [0, 0])
+                u[0] += o.size
+                u[1] += 1
+        return usage, myfiles
+
+    def _covered(self, path):
+        """
+        Do we already have sums for path from an earlier scan?
+        """
+        for root, depth in self.scanned.items():
+            if path.startswith(root):
+                if depth is None or path[len(root):].count('/') < depth:
+                    return True
+        return False
+
+    def _snapshot_file(self, bucket):
+        """ Where the cache snapshot for a bucket lives """
+        return SNAPSHOT_DIR/f'pfs-{self.alias}-{bucket}.pkl'
+
+    def _cache(self, bucket=None):
+        """
+        Get the listing cache for a bucket (default, the current one)
+        """
+        if bucket is None:
+            bucket = self.bucket
+        if bucket not in self.caches:
+            self.caches[bucket] = PrefixCache(ttl=self.ttl, max_objects=self.max_objects)
+            if self.snapshot:
+                self.caches[bucket].restore(self._snapshot_file(bucket))
+        return self.caches[bucket]
+
+    def _save(self):
+        """
+        Save snapshots of our caches
+        """
+        if self.snapshot:
+            for bucket, cache in self.caches.items():
+                cache.save(self._snapshot_file(bucket))
+
+    def _removed(self, name, bucket=None):
+        """ Record that we have removed an object """
+        self._cache(bucket).remove(name)
+        self._forget()
+
+    def _added(self, name, size, last_modified, bucket=None):
+        """ Record that we have created an object """
+        if last_modified is None:
+            last_modified = datetime.now(timezone.utc)
+        self._cache(bucket).add(name, size, last_modified)
+        self._forget()
 
     def _recurse(self, path, match=None):
         """ 
-        From a given path, head down the tree and do some summing
+        From a given path, head down the tree and do some summing. Unless we
+        have a max_depth, this comes from the listing cache, which we only fill
+        (with one recursive listing) if it doesn't already cover the path.
         """
-        if path == "":
-            prefix = None
-        else:
-            prefix = path
-        objects = self.client.list_objects(self.bucket,prefix=prefix)
-        if match is not None:
-            objects = [o for o in objects if Path(o.object_name).match(match)]
+        if self.max_depth is not None:
+            return self._recurse_depth(path, match)
+        cache = self._cache()
+        if cache.covering(path) is None:
+            prefix = path if path != "" else None
+            cache.load(path, self.client.list_objects(self.bucket, prefix=prefix, recursive=True))
+            if self.snapshot:
+                cache.save(self._snapshot_file(self.bucket))
+        sum, files, dirs, mydirs, myfiles = cache.summary(path, match)
+        mydirs = [[d, fmt_size(dsum)] for d, dsum in mydirs]
+        myfiles = [[name, fmt_size(size), fmt_date(date)] for name, size, date in myfiles]
+        return sum, files, dirs, mydirs, myfiles
 
-        sum  = 0
-        files = 0
-        dirs = 1
+    def _recurse_depth(self, path, match=None):
+        """ 
+        From a given path, head down the tree and do some summing (in one pass
+        over the listing). Sums are remembered, so that going to a directory
+        we have already summed only needs a listing of the files at that level.
+        """
+        if match is None and self._covered(path):
+            myfiles = [[o.object_name, fmt_size(o.size), fmt_date(o.last_modified)]
+                for o in self.client.list_objects(self.bucket, prefix=path if path != "" else None)
+                if not o.is_dir]
+            usage = self.usage
+        else:
+            usage, myfiles = self._scan(path, match)
+            if match is None:
+                self.usage.update(usage)
+                self.scanned[path] = self.max_depth
+        sum, files = usage.get(path, [0, 0])
         mydirs = []
-        myfiles = []
-        for o in objects:
-            if o.is_dir:
-                path = f'{path}/{o.object_name}'
-                dsum, dfiles, ddirs, md, mf = self._recurse(path)
-                sum += dsum
-                files += dfiles
+        dirs = 1
+        for p, (dsum, dfiles) in usage.items():
+            if p != path and p.startswith(path):
                 dirs += 1
-                mydirs.append([o.object_name, fmt_size(dsum)])
-            else:
-                sum += o.size
-                files +=1
-                myfiles.append([o.object_name, fmt_size(o.size), fmt_date(o.last_modified)])
-        return sum, files, dirs, mydirs, myfiles
+                if p[len(path):].count('/') == 1:
+                    mydirs.append([p, fmt_size(dsum)])
+        return sum, files, dirs, sorted(mydirs), myfiles
 
     def _next(self, commands):
         """ 
@@ -109,6 +238,7 @@ class PsuedoFileSystem:
             click.echo(_i('Please enter one of the available commands: ')+ _p(" ".join(commands)))
             self._next(commands)
         if bits[0] == 'exit':
+            self._save()
             exit()
         match bits[0]:
             case 'cb': 
@@ -202,9 +332,10 @@ class PsuedoFileSystem:
         """
 
         path = self.path + ''.join(extras)
-        objects = lswild(self.client, self.bucket, path)
-        rm(self.client, self.bucket, objects)
-        self.cd(path)
+        listing = lambda: lswild(self.client, self.bucket, path, objects=True)
+        for name in rm(self.client, self.bucket, listing, threads=self.threads):
+            self._removed(name)
+        self.cd(self.path)
 
     def mb(self, bucket_name):
         """ 
@@ -218,66 +349,73 @@ class PsuedoFileSystem:
             
             self.cb(None)
         r = self.client.make_bucket(bucket_name)
+        bucket_made(self.client, bucket_name)
         self.buckets.append(bucket_name)
+        # we know exactly what's in it
+        self._cache(bucket_name).load('', [])
         self.cb(bucket_name)
 
 
     def mv(self, command):
         """
-        Move files from one location to another (server side)
-        This is an expensive operation!
+        Move files from one location to another (server side, concurrently).
+        The target is either /path in this bucket, or bucket/path. If it is a 
+        directory (ends with /), files keep their names relative to where we are
+        (the current directory), e.g. from /a/, "mv b/* /c/" moves a/b/x to c/b/x
+        (before, the whole object name was appended, giving /c//a/b/x).
+        This is an expensive operation! Interrupted moves resume from a journal.
         """
         try:
             source, target = tuple(command)
         except:
-            click.echo(_p('Invalid mv command'))
+            click.echo(_p('Invalid mv command: mv source target, where target is /path or bucket/path,'
+                          ' and a directory target/ keeps names relative to the current directory'))
             self.cd(self.path)
 
         if target.startswith('/'):
             target_bucket = self.bucket
+            target = target[1:]
         else:
             bits = target.split('/')
             if bits[0] not in self.buckets:
                 click.echo(_p('Invalid mv command: target must start with a bucket name or /'))
                 self.cd(self.path)
             target_bucket = bits[0]
+            target = '/'.join(bits[1:])
 
-        if target.endswith('/'):
-            singleton = False
-        else:
-            if source.find('*') > -1 or source.endswith('/'):
-                click.echo(_p('Cannot move multiple files to a target that is not a directory'))
-                self.cd(self.path)
-                singleton= True
-
+        singleton = not (target.endswith('/') or target == '')
+        if singleton and (source.find('*') > -1 or source.endswith('/')):
+            click.echo(_p('Cannot move multiple files to a target that is not a directory'))
+            self.cd(self.path)
 
         path = self.path + ''.join(source)
-        objects = lswild(self.client, self.bucket, path, objects=True)
+        objects = list(lswild(self.client, self.bucket, path, objects=True))
         if singleton:
             if len(objects) != 1:
                 click.echo(_p('Unexpected error cannot mv multiple files to one file'))
                 self.cd(self.path)
             targets = [target]
         else:
-            targets = [f'{target}/{o.object_name}' for o in objects]
+            targets = [f'{target}{o.object_name[len(self.path):]}' for o in objects]
         click.echo(_i('\nList of movements:'))
         for o,t in zip(objects,targets):
-            click.echo(_e(f'mv {o.object_name} to {t}'))
+            click.echo(_e(f'mv {o.object_name} to {target_bucket}/{t}'))
         volume = fmt_size(sum([o.size for o in objects]))
         print(_p('This move is done as a server side copy - it is not "just" a rename!'))
         if click.confirm(_p(f'Move these files ({volume}) ?'), default=False):
-            for o,t in zip(objects, targets):
-                src = CopySource(self.bucket, o.object_name)
-                result = self.client.copy_object(self.bucket, t, src)
-                if singleton:
-                    if o.size != result.size:
-                        click.echo(_p(f'Failed copy of {o.object_name} - mv operation terminated'))
-                        self.cd(self.path)
-                if not singleton and result.object_name != o.object_name:
-                    click.echo(_p(f'Failed copy of {o.object_name} - mv operation terminated'))
-                    self.cd(self.path)
-                self.client.remove_object(self.bucket,o.object_name)
-                click.echo(f'Created {_e(result.object_name)}')
-            
+            key = hashlib.md5(f'{self.bucket} {path} {target_bucket} {target}'.encode()).hexdigest()[:12]
+            journal = SNAPSHOT_DIR/f'mv-{self.alias}-{key}.jsonl'
+            summary = move_objects(self.client, self.bucket, list(zip(objects, targets)), 
+                                   target_bucket=target_bucket, threads=self.threads, journal=journal)
+            for o, t, stat in summary['copied']:
+                self._added(t, o.size, stat.last_modified, target_bucket)
+            for name in summary['removed_names']:
+                self._removed(name)
+            click.echo(_i(f"Moved {summary['moved']} files ({fmt_size(summary['bytes'])}) in {summary['copy_seconds']:.1f}s ")
+                       + _e(f"({fmt_size(summary['rate'])}/s)") + _i(f", removed {summary['removed']} sources"))
+            if summary['failed']:
+                for name, reason in summary['failed']:
+                    click.echo(_p(f'Failed {name}: {reason}'))
+                click.echo(_p(f'Run the same mv again to resume (journal {journal})'))
     
-        self.cd(self.path)
\ No newline at end of file
+        self.cd(self.path)
@@ -0,0 +1,173 @@
+import os
+import re
+from pathlib import Path
+
+MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+
+# A rough cost model for a task (seconds per byte of pp read and written, and
+# seconds per record), to be calibrated from the timings of real tasks.
+DEFAULT_COST_MODEL = {'seconds_per_byte': 1/50e6, 'seconds_per_record': 0.005}
+
+# The estimated runtime (seconds) we pack each task up to by default
+DEFAULT_BUDGET_SECONDS = 4*3600
+
+
+def file_start(path):
+    """
+    The start (year, month, day) of a UM pp file from its name, e.g.
+    ch330a.p519800101.pp, ch330a.p51980jan.pp or ch330a.py1980.pp, with
+    None for anything we can't tell.
+    """
+    name = Path(path).name.lower()
+    match = re.search(r'(\d{4})(\d{2})(\d{2})(?!\d)', name)
+    if match:
+        return tuple(int(x) for x in match.groups())
+    match = re.search(r'(\d{4})(' + '|'.join(MONTHS) + ')', name)
+    if match:
+        return int(match.group(1)), MONTHS.index(match.group(2)) + 1, None
+    match = re.search(r'(?<!\d)(\d{4})(?!\d)', name)
+    if match:
+        return int(match.group(1)), None, None
+    return None, None, None
+
+
+def describe_files(files, summary=None):
+    """
+    Size each file, and if we have a summary of the pp header index (see
+    PPIndex.file_summary, made once for all the files we plan), count its
+    records and take its start from the data rather than the name.
+    Returns a list of dictionaries (name, bytes, records, start).
+    """
+    summary = summary or {}
+    described = []
+    for f in files:
+        info = summary.get(str(f))
+        start = file_start(f)
+        if info is not None and info['first'] is not None:
+            start = info['first'][:3]
+        described.append({'name': str(f), 'bytes': os.path.getsize(f),
+                          'records': info['records'] if info else None,
+                          'start': start})
+    return described
+
+
+def by_start(files):
+    """ Order (described) files by their start, then name, with those we can't date last """
+    def key(info):
+        start = info['start']
+        return (start[0] is None, tuple(-1 if x is None else int(x) for x in start), info['name'])
+    return sorted(files, key=key)
+
+
+def _period(info, align, position):
+    """ The aggregation period a file belongs to """
+    year, month, day = info['start']
+    if isinstance(align, int):
+        return position // align
+    if align == 'month' and month is not None:
+        return (year, month)
+    if align in ('year', 'month') and year is not None:
+        return (year,) if align == 'year' else (year, None)
+    return None
+
+
+def task_cost(files, cost_model=DEFAULT_COST_MODEL):
+    """ Estimated cost of a task made of these (described) files """
+    nbytes = sum(f['bytes'] for f in files)
+    counted = [f['records'] for f in files if f['records'] is not None]
+    records = sum(counted) if len(counted) == len(files) else None
+    seconds = nbytes * cost_model['seconds_per_byte']
+    if records is not None:
+        seconds += records * cost_model['seconds_per_record']
+    return {'files': len(files), 'bytes': nbytes, 'records': records, 'seconds': round(seconds, 1)}
+
+
+def plan_tasks(files, align='month', budget_bytes=None, budget_seconds=DEFAULT_BUDGET_SECONDS,
+               cost_model=DEFAULT_COST_MODEL, equal_spans=False):
+    """
+    Split (described, ordered, see by_start) files into tasks. Files are first
+    grouped into calendar periods (align is 'month', 'year' or a fixed number of
+    files), which are never split, then consecutive periods are packed into each
+    task until the next would take it over the budget (bytes and/or estimated
+    seconds), so that uneven periods still make even tasks. A period bigger than
+    the budget has a task to itself, and with no budget each period is a task.
+    With equal_spans, every task instead takes the same number of periods, judged
+    by the biggest period, so that output files cover the same span.
+    Every file ends up in a task (the last may be short).
+    Returns a list of (files, cost) pairs.
+    """
+    periods = []
+    for position, info in enumerate(files):
+        key = _period(info, align, position)
+        if not periods or periods[-1][0] != key:
+            periods.append((key, []))
+        periods[-1][1].append(info)
+    if not periods:
+        return []
+    periods = [p for k, p in periods]
+
+    def over(cost):
+        return ((budget_bytes and cost['bytes'] > budget_bytes) or
+                (budget_seconds and cost['seconds'] > budget_seconds))
+
+    if not (budget_bytes or budget_seconds):
+        groups = periods
+    elif equal_spans:
+        per_task = len(periods)
+        biggest = max((task_cost(p, cost_model) for p in periods), key=lambda c: c['bytes'])
+        if budget_bytes:
+            per_task = min(per_task, int(budget_bytes // max(biggest['bytes'], 1)))
+        if budget_seconds:
+            per_task = min(per_task, int(budget_seconds // max(biggest['seconds'], 1e-9)))
+        per_task = max(per_task, 1)
+        groups = [[f for p in periods[i:i+per_task] for f in p] for i in range(0, len(periods), per_task)]
+    else:
+        groups = [[]]
+        for p in periods:
+            if groups[-1] and over(task_cost(groups[-1] + p, cost_model)):
+                groups.append([])
+            groups[-1] += p
+
+    return [([f['name'] for f in group], task_cost(group, cost_model)) for group in groups]
+
+
+def test_planner():
+    """ Check calendar grouping, budgets and remainders """
+    assert file_start('ch330a.p519800101.pp') == (1980, 1, 1)
+    assert file_start('/a/u-ch330/1hrly/ch330a.p51981feb.pp') == (1981, 2, None)
+    assert file_start('ch330a.py1980.pp') == (1980, None, None)
+    # 2 files (of 10 bytes, 5 records) per 360 day month, for 14 months
+    files = []
+    for m in range(14):
+        for half in (1, 16):
+            files.append({'name': f'f{m}_{half}', 'bytes': 10, 'records': 5,
+                          'start': (1980 + m//12, m % 12 + 1, half)})
+    tasks = plan_tasks(files, 'month', budget_bytes=45, budget_seconds=None)
+    assert [t[1]['files'] for t in tasks] == [4]*7
+    assert sum(len(t[0]) for t in tasks) == len(files)
+    tasks = plan_tasks(files, 'year', budget_seconds=None)
+    assert [t[1]['files'] for t in tasks] == [24, 4]
+    tasks = plan_tasks(files, 'month', budget_seconds=1,
+                       cost_model={'seconds_per_byte': 0, 'seconds_per_record': 0.1})
+    assert len(tasks) == 14 and tasks[0][1]['seconds'] == 1.0
+    # by default, everything here fits in one task
+    assert len(plan_tasks(files, 'month')) == 1
+    # fixed size groups keep the remainder
+    tasks = plan_tasks(files, 5, budget_bytes=50, budget_seconds=None)
+    assert [t[1]['files'] for t in tasks] == [5]*5 + [3]
+    # uneven months (one with 4 files, one missing files) are packed to the budget,
+    # unless we ask for equal spans; a month over the budget is a task on its own
+    uneven = [f for f in files if f['start'][1] != 3]
+    uneven += [dict(f, name=f['name']+'x') for f in files if f['start'][:2] == (1980, 6)]
+    uneven += [{'name': 'big', 'bytes': 100, 'records': 5, 'start': (1981, 3, 1)}]
+    uneven = by_start(uneven)
+    assert uneven[-1]['name'] == 'big' and [f['name'] for f in uneven[8:12]] == ['f5_1', 'f5_1x', 'f5_16', 'f5_16x']
+    tasks = plan_tasks(uneven, 'month', budget_bytes=80, budget_seconds=None)
+    assert [t[1]['bytes'] for t in tasks] == [80, 80, 80, 40, 100]
+    assert sum(len(t[0]) for t in tasks) == len(uneven)
+    tasks = plan_tasks(uneven[:-1], 'month', budget_bytes=80, budget_seconds=None, equal_spans=True)
+    assert [t[1]['bytes'] for t in tasks] == [40, 40, 60, 40, 40, 40, 20]
+
+
+if __name__ == "__main__":
+    test_planner()
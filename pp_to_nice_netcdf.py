@@ -1,13 +1,26 @@
 import cf
-from time import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
 from uuid import uuid4
 import json
 import os
+import sys
+import tempfile
+from pathlib import Path
 import numpy as np
-from upload import move_to_s3
+from upload import UploadPipeline
+from s3core import get_client
+from manifest import Manifest, list_outputs
 
 from common_concept import CommonConcepts
-from get_chunkshape import get_chunkshape
+from get_chunkshape import get_chunkshape, choose_profile, profile_chunkshape, estimate_read_cost
+from rechunk import rechunk_field, DEFAULT_MEMORY_LIMIT
+from ppindex import PPIndex
+from instrument import Instrument, Span, SPANS
+
+# Default estimated field bytes allowed in flight across all writer processes
+DEFAULT_WORKER_MEMORY = 16e9
 
 def make_filename(identity, attributes,frequency,starting,length):
     """ 
@@ -71,16 +84,185 @@ def get_frequency_attribute(f):
     return ti
 
 
+def get_axis_types(f):
+    """
+    The coordinate type ('T','Z','Y','X' or None) of each data axis of f
+    """
+    types = []
+    for axis in f.get_data_axes():
+        coordinate = f.dimension_coordinate(axis, default=None)
+        types.append(None if coordinate is None else coordinate.ctype)
+    return types
+
+
+def field_nbytes(f):
+    """
+    Size of the (uncompressed) field data in bytes
+    """
+    return int(f.data.size) * f.data.dtype.itemsize
+
+
+def _write_field(f, ss, global_attributes, storage_options, logging=False, plan=None):
+    """
+    Write (and if necessary rechunk) the field f to the file ss,
+    and return the file name and the measurements (see instrument.Span) of the
+    rechunk (temp-write) and the write (final-write). This is
+    the unit of work which can be farmed out to a worker process. If we
+    have a plan of where the field records are in the PP files we rechunk from that.
+    """
+    if logging:
+        print('\nWriting: ', ss)
+    compress = storage_options['compress']
+    shuffle = storage_options['shuffle']
+    spans = []
+    nbytes = field_nbytes(f)
+    current_chunking = f.data.nc_hdf5_chunksizes()
+    if logging:
+        print(f'Writing array [{f.data.shape}] with chunk shape {current_chunking}.' )
+    if current_chunking[0]!=1:
+        # We have to deal with an horrific issue with reading pp data. Effectively we would
+        # read the entire data many times and slice in memory. Instead we read each record
+        # once into a (memory or memory-mapped) buffer and stream the chunks from that.
+        with Span('temp-write', bytes_in=nbytes, file=ss) as span:
+            f, rechunk_stats = rechunk_field(f, current_chunking,
+                memory_limit=storage_options.get('rechunk_memory', DEFAULT_MEMORY_LIMIT),
+                scratch_dir=storage_options.get('rechunk_scratch', None),
+                logging=logging, plan=plan)
+            span.bytes_out = rechunk_stats['bytes']
+            span.labels.update(buffer=rechunk_stats['mode'], source=rechunk_stats['source'])
+        spans.append(span.record)
+    with Span('final-write', bytes_in=nbytes, file=ss) as span:
+        cf.write(f, ss,
+                compress=compress, shuffle=shuffle,
+                file_descriptors=global_attributes
+                )
+        span.bytes_out = os.path.getsize(ss)
+    spans.append(span.record)
+    peak = span.record['peak_rss']
+    if logging:
+        print(f"... file {ss} written {span.record['wall']:.1f}" + ('' if peak is None else f" (peak RSS {peak/1e9:.2f}GB)"))
+    return ss, spans
+
+
+def _write_pool(jobs, workers, memory_limit):
+    """
+    Write fields using a pool of worker processes. Each job is a tuple of
+    (estimated bytes, arguments to _write_field). Jobs are admitted in order,
+    but only while the estimated bytes of all the jobs in flight stay below
+    memory_limit (a job is always admitted if nothing else is running), so
+    that big 3D fields do not get scheduled together.
+    Yields what _write_field returns as the fields are written.
+    """
+    pending = deque(jobs)
+    running = {}
+    in_flight = 0
+    # spawn, not fork, since the parent may already have dask threads running
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        while pending or running:
+            while pending and len(running) < workers:
+                nbytes = pending[0][0]
+                if running and in_flight + nbytes > memory_limit:
+                    break
+                nbytes, args = pending.popleft()
+                running[pool.submit(_write_field, *args)] = nbytes
+                in_flight += nbytes
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight -= running.pop(future)
+                yield future.result()
+
+
+def _field_groups(myfiles, ppindex, processing_options, storage_options, instrument,
+                  finished=None, logging=False):
+    """
+    The fields of a task, as one or more FieldLists. Normally we read every
+    field in one go, but in streaming mode we copy the records of each
+    group of STASH codes (see PPIndex.stash_groups) into scratch PP files and
+    read them one group at a time, so that only one group of fields is held
+    in memory. Each group is read when the previous one is finished with,
+    and its scratch files removed. Groups for which finished(group key) is
+    true are not read at all. Each read is measured as a span of instrument.
+    Yields (fields, the read span, the group key, or None if not streaming).
+    """
+    if not processing_options.get('streaming') or ppindex is None:
+        if processing_options.get('streaming'):
+            print('Streaming needs a PP index, reading all fields at once')
+        with instrument.span('read', bytes_in=sum(os.path.getsize(f) for f in myfiles)) as span:
+            fields = cf.read(myfiles)
+        yield fields, span, None
+        return
+    groups = ppindex.stash_groups(processing_options.get('stream_group_bytes', None))
+    if logging:
+        print(f'Streaming {len(ppindex)} records in {len(groups)} groups')
+    scratch = processing_options.get('stream_scratch', None) or storage_options.get('rechunk_scratch', None)
+    for n, records in enumerate(groups):
+        key = ppindex.group_key(records)
+        if finished is not None and finished(key):
+            continue
+        with tempfile.TemporaryDirectory(dir=scratch) as tmp:
+            with instrument.span('read', bytes_in=ppindex.nbytes[records].sum(), group=n) as span:
+                subset = ppindex.extract(records, tmp, prefix=f'group{n:04d}')
+                span.bytes_out = sum(os.path.getsize(f) for f in subset)
+                fields = cf.read(subset)
+            yield fields, span, key
+            del fields
+
+
+def _finished_group(manifest, key, objects, uploader):
+    """
+    Is a (streamed) group finished, according to the manifest? Only if
+    every output made from it is finished, or at least written, in which
+    case those still to go are handed to the uploader (if we have one).
+    """
+    outputs = manifest.group_outputs(key)
+    if outputs is None:
+        return False
+    status = {ss: manifest.status(ss, objects) for ss in outputs}
+    if None in status.values():
+        return False
+    print(f'Skipping {key} (already done)')
+    if uploader is not None:
+        for ss, state in status.items():
+            if state == 'written':
+                print(f'... but uploading {ss}')
+                uploader.put(ss)
+    return True
+
+
+def _check(check, uploader):
+    """ Call check (if we have one), and if it raises, give up the uploads still waiting """
+    if check is None:
+        return
+    try:
+        check()
+    except BaseException:
+        if uploader is not None:
+            uploader.abandon()
+        raise
 
 
 def pp2nc_from_config(cc, config_file, task_number, 
                         target=None, bucket=None, 
-                        logging=False, dummy_run=False):
+                        logging=False, dummy_run=False, force=False, check=None):
     """ 
     Convert pp files to netcdf using a specifc task_number 
     from an instance of the json configuration 
     created following the eg_1280 template 
     and found in config_file.
+    Outputs are recorded in a manifest for the task as they are finished,
+    and unless we force it, outputs the manifest says are already finished
+    (in the bucket, or on disk if we're not uploading) are not done again.
+    The names of the outputs are only known once the fields have been read
+    and identified, so when not streaming a rerun still reads every field.
+    When streaming, a STASH group whose outputs were all finished is not read.
+    Each stage (read, identify, chunk-plan, temp-write, final-write and upload) is
+    measured and written as json lines to a file for the task in instrument_dir
+    (see instrument.py for the summary of a whole run).
+    If we are given check (e.g. by a work queue), it is called before each group
+    and after each output is written, and if it raises (e.g. because another
+    worker has taken over the task) we stop, without uploading anything more.
+    Returns the peak memory (RSS, bytes) while reading and writing each output.
     """
     with open(config_file,'r') as f:
         configuration = json.load(f)
@@ -88,6 +270,8 @@ def pp2nc_from_config(cc, config_file, task_number,
     mytask = configuration['tasks'][task_number]
     simulation = mytask[0]
     myfiles = mytask[1]
+    if len(mytask) > 2 and logging:
+        print('Estimated task cost:', mytask[2])
 
     global_attributes = configuration['experiment_detail']
     global_attributes['runid'] = simulation
@@ -103,74 +287,151 @@ def pp2nc_from_config(cc, config_file, task_number,
         print('Reading')
         print(myfiles)
         print('---')
-    e1 = time()
-    fields = cf.read(myfiles)
-    e2 = time()
-    if logging:
-        print(f'\nReading completed in {e2-e1:.1f}s\n')
-
-    for f in fields:
-        fkey = get_frequency_attribute(f)
-        tc = f.coordinate('T').data
-        common_concept_name = cc.identify(f)
-        if common_concept_name.startswith('UM'):
-            pass
-        else:
-            f.set_property('common_name',f'cmip6:{common_concept_name}')
-            chunk_shape = get_chunkshape(np.array(f.data.shape), configuration['storage_options']['chunksize'])
-            # yes, the method has the wrong name
-            f.data.nc_set_hdf5_chunksizes(chunk_shape)
-        print(global_attributes)
-        ss = make_filename(common_concept_name, global_attributes, fkey, tc[0], len(tc))
-        print('\nWriting: ', ss)
-        if dummy_run:
-            print(global_attributes)
+
+    storage_options = configuration['storage_options']
+    processing_options = configuration.get('processing_options', {})
+    workers = processing_options.get('workers', 1)
+
+    # scan the PP headers once, so that rechunking can read each record directly
+    # (from the shared stored index, if there is one)
+    ppindex = None
+    if storage_options.get('pp_index', True) or processing_options.get('streaming'):
+        try:
+            if processing_options.get('pp_index_file'):
+                ppindex = PPIndex.load(processing_options['pp_index_file'], myfiles, logging=logging)
+            else:
+                ppindex = PPIndex(myfiles, logging=logging)
+        except (OSError, ValueError, KeyError) as err:
+            print(f'Not using a PP index ({err})')
+    # (the index may only have been wanted for streaming)
+    plan_index = ppindex if storage_options.get('pp_index', True) else None
+
+    if processing_options.get('identify_cache'):
+        cc.load_cache(processing_options['identify_cache'])
+
+    manifest = Manifest.for_task(processing_options.get('manifest_dir', 'manifests'), task_number)
+    instrument = Instrument.for_task(processing_options.get('instrument_dir', 'instrument'), task_number,
+                                     simulation=simulation)
+    # the variable and frequency of each output, to label its spans
+    labels = {}
+    uploading = bucket is not None and target is not None
+    objects = None
+    if uploading and not force and manifest.needs_listing():
+        # only the uploads the manifest knows about can be finished
+        objects = list_outputs(get_client(target), bucket, manifest.uploaded_objects())
+
+    uploader = None
+    if uploading:
+        uploader = UploadPipeline(target, bucket,
+                    on_uploaded=lambda ss, size, hashes: manifest.uploaded(ss, Path(ss).stem, size, hashes),
+                    on_span=lambda record: instrument.add({**record, **labels.get(record['file'], {})}),
+                    threads=processing_options.get('upload_threads', 2),
+                    queue_size=processing_options.get('upload_queue', 4),
+                    max_pending_bytes=processing_options.get('upload_pending_bytes', 50e9),
+                    part_size=processing_options.get('upload_part_size', None),
+                    parallel=processing_options.get('upload_parallel', 1),
+                    logging=logging)
+
+    peaks = {}
+    finished = None if force or dummy_run else (
+        lambda key: _finished_group(manifest, key, objects, uploader))
+    for fields, read, key in _field_groups(myfiles, ppindex, processing_options, storage_options,
+                                           instrument, finished=finished, logging=logging):
+        _check(check, uploader)
+        read_peak = read.record['peak_rss']
+        if logging:
+            print(f"\nRead {len(fields)} fields in {read.record['wall']:.1f}s" +
+                  ('' if read_peak is None else f' (peak RSS {read_peak/1e9:.2f}GB)') + '\n')
+
+        jobs = []
+        outputs = []
+        for f in fields:
+            with instrument.span('identify') as span:
+                fkey = get_frequency_attribute(f)
+                tc = f.coordinate('T').data
+                common_concept_name = cc.identify(f)
+                span.labels.update(variable=common_concept_name, frequency=fkey)
+            plan = None
+            if common_concept_name.startswith('UM'):
+                pass
+            else:
+                with instrument.span('chunk-plan', bytes_in=field_nbytes(f), **span.labels):
+                    f.set_property('common_name',f'cmip6:{common_concept_name}')
+                    profile = choose_profile(storage_options, common_concept_name, fkey)
+                    if profile is None:
+                        chunk_shape = get_chunkshape(np.array(f.data.shape), storage_options['chunksize'])
+                    else:
+                        axes = get_axis_types(f)
+                        chunk_shape = profile_chunkshape(np.array(f.data.shape), axes, 
+                                            storage_options['chunksize'], profile, logging=logging)
+                        f.set_property('chunk_profile', profile)
+                        for query, cost in estimate_read_cost(f.data.shape, chunk_shape, axes).items():
+                            f.set_property(f'chunk_cost_{query}', cost)
+                    # yes, the method has the wrong name
+                    f.data.nc_set_hdf5_chunksizes(chunk_shape)
+                    if plan_index is not None and chunk_shape[0] != 1:
+                        plan = plan_index.plan(f)
+            if logging:
+                print(global_attributes)
+            ss = make_filename(common_concept_name, global_attributes, fkey, tc[0], len(tc))
+            labels[ss] = span.labels
+            outputs.append(ss)
+            if dummy_run:
+                print('\nWriting: ', ss)
+                print(global_attributes)
+            else:
+                jobs.append((field_nbytes(f), (f, ss, global_attributes, storage_options, logging, plan)))
+
+        if not force:
+            todo = []
+            for job in jobs:
+                ss = job[1][1]
+                status = manifest.status(ss, objects)
+                if status == 'uploaded' or (status == 'written' and not uploading):
+                    print(f'Skipping {ss} (already {status})')
+                elif status == 'written':
+                    print(f'Skipping {ss} (already written, will upload)')
+                    uploader.put(ss)
+                else:
+                    todo.append(job)
+            jobs = todo
+
+        if workers > 1:
+            written = _write_pool(jobs, workers,
+                        processing_options.get('worker_memory', DEFAULT_WORKER_MEMORY))
         else:
-            compress = configuration['storage_options']['compress']
-            shuffle = configuration['storage_options']['shuffle']
-            e3a = time()
-            current_chunking = f.data.nc_hdf5_chunksizes()
-            print(f'Writing array [{f.data.shape}] with chunk shape {current_chunking}.' )
-            ss1 = ""
-            if current_chunking[0]!=1:
-                # We have to deal with an horrific issue with reading pp data. Effectively we have
-                # read the entire data many times and slice in memory. It's much faster to simply
-                # write the data out and rechunk from the netcdf version - though it's still
-                # slow!
-                print('Need to use temp file')
-                new_chunk = list(f.data.shape)
-                new_chunk[0] = 1
-                ss1 = ss[0:-3]+'-tmp.nc'
-                e3a1 = time()
-                if logging:
-                    print(new_chunk)
-                f.data.nc_set_hdf5_chunksizes(new_chunk)
-                # we try not compressing the temporary data in the hope it will speed things up
-                cf.write(f,ss1,compress=0, shuffle=False,
-                    file_descriptors=global_attributes)
-                e3a2 = time()
-                if logging:
-                    print(f'first temp file written {e3a2-e3a1:.1f}')
-                f = cf.read(ss1)[0]
-                f.data.nc_set_hdf5_chunksizes=current_chunking
-                e3a3 = time()
-                if logging:
-                    print(f'lazy reading temp file took {e3a3-e3a2:.1f}s')
-            cf.write(f, ss,
-                    compress=compress, shuffle=shuffle,
-                    file_descriptors=global_attributes
-                    )
-            e3b = time()
-            print(f"... file {ss} written {e3b-e3a:.1f}")
-            if ss1 != '': 
-                os.remove(ss1)
-            if bucket is not None and target is not None:
-                move_to_s3(ss, target, bucket)
-                e3c = time()
-                print(f'...file moved to s3 in {e3c-e3b:.1f}s')
-    e3 = time()
+            written = (_write_field(*args) for nbytes, args in jobs)
+
+        for ss, spans in written:
+            _check(check, uploader)
+            # (the write may have been measured in a worker process)
+            for record in spans:
+                instrument.add({**record, **labels[ss]})
+            # the read is done here, but the write may have been in a worker process
+            known = [p for p in [read_peak] + [r['peak_rss'] for r in spans] if p is not None]
+            peaks[ss] = max(known) if known else None
+            # (if we're uploading, the checksum comes with the upload)
+            manifest.written(ss, checksum=uploader is None, peak_rss=peaks[ss])
+            if uploader is not None:
+                uploader.put(ss)
+        if key is not None and not dummy_run:
+            manifest.group_done(key, outputs)
+        del fields, jobs
+
+    cc.save_cache()
     if logging:
-        print(f'\nWriting {len(fields)} files took {e3-e2:.1f}s\n')
+        print('Identification cache:', cc.cache_stats())
+    if uploader is not None:
+        uploader.close()
+    for name in SPANS:
+        n, wall, bytes_in, bytes_out = instrument.totals(name)
+        if n:
+            print(f'{name}: {n} in {wall:.1f}s, {bytes_in/1e6:.1f}MB in, {bytes_out/1e6:.1f}MB out'
+                  f' ({bytes_in/1e6/max(wall, 1e-9):.1f}MB/s)')
+    known = [p for p in peaks.values() if p is not None]
+    if known:
+        print(f'Peak RSS per field: max {max(known)/1e9:.2f}GB, mean {sum(known)/len(known)/1e9:.2f}GB')
+    return peaks
 
 
 if __name__ == "__main__":
@@ -180,5 +441,5 @@ if __name__ == "__main__":
     print(f"Using task {task_number} from {config_file}")
     pp2nc_from_config(cc, config_file, task_number, 
                     target ='hpos', bucket='bnl',
-                    logging=True, dummy_run=False)
+                    logging=True, dummy_run=False, force='--force' in sys.argv)
     
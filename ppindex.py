@@ -0,0 +1,601 @@
+import os
+import re
+import sys
+from pathlib import Path
+from time import time
+import numpy as np
+
+try:
+    from umfive.wgdos import unpack_wgdos
+except ImportError:
+    unpack_wgdos = None
+
+# Positions (from zero) of the header words we use, integers first, then reals
+LBYR, LBYRD, LBTIM, LBLREC, LBROW, LBNPT, LBEXT, LBPACK = 0, 6, 12, 14, 17, 18, 19, 20
+LBPROC, LBVC, LBLEV, LBUSER1, LBUSER4, LBUSER7 = 24, 25, 32, 38, 41, 44
+BDATUM, BLEV, BMDI, BMKS = 4, 6, 17, 18
+NINTS, NREALS = 45, 19
+
+# Packing codes (lbpack % 10) we can read
+UNPACKED, WGDOS = 0, 1
+
+# The header words kept in a stored index (everything we use, including
+# the time bounds, level, grid and packing), and the store layout version
+INT_WORDS = (list(range(LBYR, LBYR+5)) + list(range(LBYRD, LBYRD+5)) +
+             [LBTIM, LBLREC, LBROW, LBNPT, LBEXT, LBPACK, LBPROC, LBVC, LBLEV, LBUSER1, LBUSER4, LBUSER7])
+REAL_WORDS = [BDATUM, BLEV, BMDI, BMKS]
+STORE_VERSION = 1
+
+
+def _stamp(path):
+    """ What we use to tell if a file has changed since we indexed it """
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class PPIndex:
+    """
+    The headers of every record in a set of PP files, scanned once, with
+    where the data lives, so that we can read any record directly (and only
+    once) however the data is going to be chunked. Headers are held as arrays
+    (ints and reals, one row per record) alongside the file, data offset
+    and data length on disk of each record.
+    """
+    def __init__(self, files=(), logging=False):
+        e1 = time()
+        self.files = [str(f) for f in files]
+        self.stamps = [_stamp(f) for f in self.files]
+        ints, reals, location = [], [], []
+        for i, path in enumerate(self.files):
+            for hi, hr, offset, nbytes, fmt in scan_pp(path):
+                ints.append(hi)
+                reals.append(hr)
+                location.append((i, offset, nbytes, fmt))
+        self.ints = np.array(ints, dtype=np.int64).reshape(-1, NINTS)
+        self.reals = np.array(reals, dtype=np.float64).reshape(-1, NREALS)
+        self.file = np.array([l[0] for l in location], dtype=np.int32)
+        self.offset = np.array([l[1] for l in location], dtype=np.int64)
+        self.nbytes = np.array([l[2] for l in location], dtype=np.int64)
+        # byte order and word size of each record, e.g. '>4'
+        self.fmt = np.array([l[3] for l in location], dtype='U2')
+        if logging:
+            print(f'Indexed {len(self)} PP records in {len(self.files)} files in {time()-e1:.1f}s')
+
+    def __len__(self):
+        return len(self.offset)
+
+    def save(self, path):
+        """
+        Save the index as a compact columnar (compressed numpy) file, with 
+        just the header words we use.
+        """
+        path = Path(path)
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as sfile:
+            np.savez_compressed(sfile, version=STORE_VERSION,
+                                files=np.array(self.files, dtype=str),
+                                stamps=np.array(self.stamps, dtype=np.int64).reshape(-1, 2),
+                                fileid=self.file, offset=self.offset, nbytes=self.nbytes, fmt=self.fmt,
+                                ints=self.ints[:, INT_WORDS].astype(np.int32),
+                                reals=self.reals[:, REAL_WORDS].astype(np.float32))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, files=None, logging=False):
+        """
+        Load a stored index, keeping only the records for files (default, all
+        of them). Any of the files which are not in the store, or which have
+        changed since they were indexed, are scanned afresh (and if we're taking
+        all of them, any which no longer exist are left out).
+        """
+        e1 = time()
+        with np.load(path) as store:
+            if int(store['version']) != STORE_VERSION:
+                raise ValueError(f'{path} is not a version {STORE_VERSION} PP index')
+            columns = {name: store[name] for name in store.files}
+        stored = {f: i for i, f in enumerate(columns['files'])}
+        wanted = list(stored) if files is None else [str(f) for f in files]
+        keep, rescan = [], []
+        for f in wanted:
+            i = stored.get(f)
+            if files is None and not os.path.exists(f):
+                continue
+            if i is not None and tuple(columns['stamps'][i]) == _stamp(f):
+                keep.append(i)
+            else:
+                rescan.append(f)
+        rows = np.flatnonzero(np.isin(columns['fileid'], keep))
+        index = cls.__new__(cls)
+        renumber = np.full(len(stored), -1, dtype=np.int32)
+        renumber[keep] = np.arange(len(keep))
+        index.files = [str(columns['files'][i]) for i in keep]
+        index.stamps = [tuple(int(x) for x in columns['stamps'][i]) for i in keep]
+        index.file = renumber[columns['fileid'][rows]]
+        for name in ('offset', 'nbytes', 'fmt'):
+            setattr(index, name, columns[name][rows])
+        index.ints = np.zeros((len(rows), NINTS), dtype=np.int64)
+        index.ints[:, INT_WORDS] = columns['ints'][rows]
+        index.reals = np.zeros((len(rows), NREALS), dtype=np.float64)
+        index.reals[:, REAL_WORDS] = columns['reals'][rows]
+        if rescan:
+            index = cls.concat([index, cls(rescan)])
+        if logging:
+            print(f'Loaded {len(index)} PP records for {len(wanted)} files from {path} '
+                  f'({len(rescan)} files rescanned) in {time()-e1:.1f}s')
+        return index
+
+    @classmethod
+    def concat(cls, indexes):
+        """ Combine indexes (of different files) into one """
+        index = cls.__new__(cls)
+        index.files, index.stamps, files = [], [], []
+        for i in indexes:
+            files.append(i.file + len(index.files))
+            index.files += i.files
+            index.stamps += i.stamps
+        index.file = np.concatenate(files).astype(np.int32)
+        for name in ('ints', 'reals', 'offset', 'nbytes', 'fmt'):
+            setattr(index, name, np.concatenate([getattr(i, name) for i in indexes]))
+        return index
+
+    def file_summary(self):
+        """
+        What is in each file, as a dictionary of file name to number of records,
+        bytes of data (on disk), the earliest validity (or mean start) and the latest 
+        (year, month, day, hour, minute) times, and the set of STASH codes.
+        """
+        nfiles = len(self.files)
+        records = np.bincount(self.file, minlength=nfiles)
+        nbytes = np.bincount(self.file, weights=self.nbytes, minlength=nfiles)
+        # the first time is the validity time or start of the mean, the
+        # second is the end of the mean or (earlier) the data time
+        t1, t2 = _time_key(self.ints[:, LBYR:LBYR+5]), _time_key(self.ints[:, LBYRD:LBYRD+5])
+        first = np.full(nfiles, np.iinfo(np.int64).max)
+        last = np.full(nfiles, np.iinfo(np.int64).min)
+        np.minimum.at(first, self.file, t1)
+        np.maximum.at(last, self.file, np.maximum(t1, t2))
+        stash = {i: set() for i in range(nfiles)}
+        for i, code in np.unique(np.stack([self.file, self.ints[:, LBUSER4]], axis=1), axis=0).tolist():
+            stash[i].add(code)
+        summary = {}
+        for i, f in enumerate(self.files):
+            empty = records[i] == 0
+            summary[f] = {'records': int(records[i]), 'bytes': int(nbytes[i]),
+                          'first': None if empty else _from_time_key(first[i]),
+                          'last': None if empty else _from_time_key(last[i]),
+                          'stash': stash[i]}
+        return summary
+
+    def take(self, records):
+        """ A new index of just these records (small enough to send to a worker) """
+        subset = PPIndex.__new__(PPIndex)
+        subset.files = self.files
+        subset.stamps = self.stamps
+        for name in ('ints', 'reals', 'file', 'offset', 'nbytes', 'fmt'):
+            setattr(subset, name, getattr(self, name)[records])
+        return subset
+
+    def stash_groups(self, max_bytes=None):
+        """
+        Split the records into groups by (model, STASH code), in the order the
+        codes first appear. With max_bytes, codes are put together (in that
+        order) until their data would exceed max_bytes on disk.
+        Returns a list of arrays of records.
+        """
+        keys = self.ints[:, LBUSER7] * 100000 + self.ints[:, LBUSER4]
+        codes, first = np.unique(keys, return_index=True)
+        groups, nbytes = [], 0
+        for code in codes[np.argsort(first)]:
+            records = np.flatnonzero(keys == code)
+            size = int(self.nbytes[records].sum())
+            if groups and max_bytes and nbytes + size <= max_bytes:
+                groups[-1] = np.concatenate([groups[-1], records])
+                nbytes += size
+            else:
+                groups.append(records)
+                nbytes = size
+        return [np.sort(g) for g in groups]
+
+    def group_key(self, records):
+        """ A name for a group of records, from the (model, STASH code)s in it """
+        codes = np.unique(self.ints[records][:, [LBUSER7, LBUSER4]], axis=0)
+        return 'stash:' + ','.join(f'{model}:{code}' for model, code in codes.tolist())
+
+    def extract(self, records, directory, prefix='subset'):
+        """
+        Copy the records (headers and data, exactly as they are) into new PP
+        files in directory, one for each of the files they come from, keeping
+        their order. Returns the new file names.
+        """
+        records = np.sort(np.asarray(records))
+        written = []
+        for i in np.unique(self.file[records]):
+            path = Path(directory)/f'{prefix}_{i:04d}_{Path(self.files[i]).name}'
+            with open(self.files[i], 'rb') as src, open(path, 'wb') as dst:
+                for r in records[self.file[records] == i]:
+                    # a record is the header (with its markers) and the data (with its markers)
+                    header = 64 * int(self.fmt[r][1])
+                    start = int(self.offset[r]) - header - 12
+                    dst.write(_read_at(src, start, int(self.nbytes[r]) + header + 16))
+            written.append(str(path))
+        return written
+
+    def select(self, stash, model=None, lbproc=None, lbtim=None):
+        """ The records for a STASH code (section*1000+item) and optionally more """
+        keep = self.ints[:, LBUSER4] == stash
+        for word, value in ((LBUSER7, model), (LBPROC, lbproc), (LBTIM, lbtim)):
+            if value is not None:
+                keep &= self.ints[:, word] == value
+        return np.flatnonzero(keep)
+
+    def times(self, record):
+        """ The first and second times (year, month, day, hour, minute) of a record """
+        hi = self.ints[record]
+        return tuple(int(x) for x in hi[LBYR:LBYR+5]), tuple(int(x) for x in hi[LBYRD:LBYRD+5])
+
+    def lookup(self, records, times, levels=None):
+        """
+        Arrange records by time and level. times is a list with, for each
+        time, either a (year, month, day, hour, minute) validity time or a
+        pair of them (the bounds of a time mean). levels is a list of level
+        values, matched to BLEV, or failing that, LBLEV. Returns an array
+        (ntimes, nlevels) of records, or None if we can't match every
+        position to exactly one record.
+        """
+        levels = [None] if levels is None else list(levels)
+        # match bounds to both times, and validity times to the first time,
+        # and only failing that to the second
+        by_bounds, by_t1, by_t2 = {}, {}, {}
+        for r in records:
+            t1, t2 = self.times(r)
+            by_bounds.setdefault((t1, t2), []).append(r)
+            by_t1.setdefault(t1, []).append(r)
+            by_t2.setdefault(t2, []).append(r)
+
+        def at_time(t):
+            if isinstance(t[0], tuple):
+                return by_bounds.get(t, [])
+            return by_t1.get(t) or by_t2.get(t, [])
+
+        def level_of(candidates, level, by):
+            if level is None:
+                return candidates
+            if by == 'blev':
+                return [r for r in candidates if np.isclose(self.reals[r, BLEV], level)]
+            return [r for r in candidates if self.ints[r, LBLEV] == level]
+
+        for by in ('blev', 'lblev'):
+            grid = np.empty((len(times), len(levels)), dtype=np.int64)
+            ok = True
+            for i, t in enumerate(times):
+                candidates = at_time(t)
+                for j, level in enumerate(levels):
+                    found = level_of(candidates, level, by)
+                    if len(found) != 1:
+                        ok = False
+                        break
+                    grid[i, j] = found[0]
+                if not ok:
+                    break
+            if ok and len(set(grid.flat)) == grid.size:
+                return grid
+            if levels == [None]:
+                break
+        return None
+
+    def read(self, record, handles=None):
+        """
+        Read and unpack one record as a 2D masked array. If handles (a dict)
+        is given, we use it to keep files open between reads.
+        """
+        hi, hr = self.ints[record], self.reals[record]
+        path = self.files[self.file[record]]
+        if handles is None:
+            with open(path, 'rb') as fh:
+                raw = _read_at(fh, self.offset[record], self.nbytes[record])
+        else:
+            if path not in handles:
+                handles[path] = open(path, 'rb')
+            raw = _read_at(handles[path], self.offset[record], self.nbytes[record])
+        order, word_size = self.fmt[record][0], int(self.fmt[record][1])
+        nrows, ncols = int(hi[LBROW]), int(hi[LBNPT])
+        nwords = nrows * ncols
+        mdi = float(hr[BMDI])
+        pack = int(hi[LBPACK]) % 10
+        kind = 'i' if hi[LBUSER1] == 2 else 'f'
+        if pack == UNPACKED:
+            data = np.frombuffer(raw, dtype=f'{order}{kind}{word_size}', count=nwords)
+        elif pack == WGDOS:
+            if unpack_wgdos is None:
+                raise NotImplementedError('WGDOS packed data needs umfive')
+            packed = int(hi[LBLREC]) * word_size - int(hi[LBEXT]) * word_size
+            if 0 < packed < len(raw):
+                raw = raw[:packed]
+            data = unpack_wgdos(raw, nwords, mdi, word_size)
+        else:
+            raise NotImplementedError(f'PP packing {hi[LBPACK]} is not supported')
+        data = np.ma.masked_equal(data.reshape(nrows, ncols), mdi)
+        bmks, bdatum = float(hr[BMKS]), float(hr[BDATUM])
+        if bmks not in (0.0, 1.0):
+            data = data * bmks
+        if bdatum != 0.0:
+            data = data + bdatum
+        return data
+
+    def plan(self, f):
+        """
+        Work out which record provides each horizontal slice of the data of the
+        field f (as read by cf), returning a RecordPlan, or None if we can't.
+        """
+        stash = _field_stash(f)
+        if stash is None:
+            return None
+        model, code = stash
+        lbproc = f.get_property('lbproc', None)
+        lbtim = f.get_property('lbtim', None)
+        records = self.select(code, model,
+                              None if lbproc is None else int(lbproc),
+                              None if lbtim is None else int(lbtim))
+        if len(records) == 0:
+            return None
+
+        axes = f.get_data_axes()
+        kinds = []
+        for axis in axes:
+            coord = f.dimension_coordinate(filter_by_axis=(axis,), default=None)
+            kinds.append(coord.ctype if coord is not None else None)
+        shape = f.data.shape
+        # we need the horizontal dimensions last, and at most time and one level axis first
+        if len(kinds) < 2 or tuple(kinds[-2:]) != ('Y', 'X'):
+            return None
+        leading = kinds[:-2]
+        if not leading or any(k not in ('T', 'Z') for k in leading) or len(set(leading)) != len(leading):
+            return None
+
+        if 'T' in leading:
+            tcoord = f.dimension_coordinate('T')
+            if tcoord.has_bounds():
+                bounds = tcoord.bounds.datetime_array
+                times = [(_ymdhm(b[0]), _ymdhm(b[1])) for b in bounds]
+            else:
+                times = [_ymdhm(t) for t in tcoord.datetime_array.flat]
+        else:
+            times = sorted(set(self.times(r)[0] for r in records))
+            if len(times) != 1:
+                return None
+        levels = None
+        if 'Z' in leading:
+            levels = [float(z) for z in f.dimension_coordinate('Z').array.flat]
+
+        grid = self.lookup(records, times, levels)
+        if grid is None:
+            return None
+        if any(self.ints[r, LBROW] != shape[-2] or self.ints[r, LBNPT] != shape[-1] for r in grid.flat):
+            return None
+        # put the grid in the order of the data dimensions
+        if leading == ['Z', 'T']:
+            grid = grid.T
+        grid = grid.reshape(shape[:-2])
+        subset = self.take(grid.ravel())
+        return RecordPlan(subset, np.arange(grid.size).reshape(grid.shape))
+
+
+class RecordPlan:
+    """
+    Which record (in a small PPIndex) provides each horizontal slice of
+    a field, so that we can read the data one leading index at a time.
+    """
+    def __init__(self, index, grid):
+        self.index = index
+        self.grid = grid
+
+    def read(self, i, handles=None):
+        """ The data for leading index i (as a masked array) """
+        records = np.atleast_1d(self.grid[i])
+        slices = [self.index.read(r, handles) for r in records.flat]
+        return np.ma.stack(slices).reshape(records.shape + slices[0].shape)
+
+
+def _read_at(fh, offset, nbytes):
+    fh.seek(offset)
+    raw = fh.read(nbytes)
+    if len(raw) < nbytes:
+        raise EOFError('Short read from PP file')
+    return raw
+
+
+def _time_key(times):
+    """ (year, month, day, hour, minute) rows as single integers which sort the same way """
+    times = np.asarray(times, dtype=np.int64)
+    return (((times[:, 0]*100 + times[:, 1])*100 + times[:, 2])*100 + times[:, 3])*100 + times[:, 4]
+
+
+def _from_time_key(key):
+    """ The (year, month, day, hour, minute) tuple for a _time_key """
+    parts = []
+    key = int(key)
+    for i in range(4):
+        key, part = divmod(key, 100)
+        parts.append(part)
+    return (key,) + tuple(reversed(parts))
+
+
+def _ymdhm(t):
+    """ A date as a (year, month, day, hour, minute) tuple """
+    return (t.year, t.month, t.day, t.hour, t.minute)
+
+
+def _field_stash(f):
+    """ The (model, stash code) of a field read by cf from PP, or None """
+    source = f.get_property('um_stash_source', None)
+    if source is not None:
+        match = re.match(r'm(\d+)s(\d+)i(\d+)', source)
+        if match:
+            model, section, item = (int(x) for x in match.groups())
+            return model, section*1000 + item
+    code = f.get_property('stash_code', None)
+    if code is not None:
+        model = f.get_property('submodel', None)
+        return (None if model is None else int(model)), int(code)
+    return None
+
+
+def scan_pp(path):
+    """
+    Scan the headers of a PP file (a sequence of Fortran records, alternately
+    a 64 word header and the data) without reading any data. Yields, for
+    each record, the integer and real header words, the offset and
+    length of the data on disk, and the byte order and word size (e.g. '>4').
+    """
+    with open(path, 'rb') as fh:
+        marker = fh.read(4)
+        if len(marker) < 4:
+            return
+        for order in ('>', '<'):
+            length = int(np.frombuffer(marker, f'{order}i4')[0])
+            if length in (256, 512):
+                break
+        else:
+            raise ValueError(f'{path} does not look like a PP file')
+        word_size = length // 64
+        head_dtype = np.dtype([('i', f'{order}i{word_size}', NINTS), ('r', f'{order}f{word_size}', NREALS)])
+        while True:
+            header = fh.read(length)
+            if len(header) < length:
+                raise EOFError(f'Truncated header in {path}')
+            header = np.frombuffer(header, head_dtype)[0]
+            fh.seek(4, 1)
+            dlen = int(np.frombuffer(fh.read(4), f'{order}i4')[0])
+            offset = fh.tell()
+            yield header['i'], header['r'], offset, dlen, f'{order}{word_size}'
+            fh.seek(offset + dlen + 4)
+            marker = fh.read(4)
+            if len(marker) < 4:
+                return
+
+
+def pp_files(origin, simulation, subdir):
+    """ All the pp files in a particular simulation directory, in order """
+    return sorted(Path(f'{origin}/{simulation}/{subdir}/').glob('*.pp'))
+
+
+def build_store(origin, simulations, subdirs, output, logging=True):
+    """
+    Build (or bring up to date) a stored index of all the pp files in
+    origin/simulation/subdir, for each of the simulations and subdirs.
+    Files which are already in the store and have not changed are not rescanned.
+    """
+    files = [f for simulation in simulations for subdir in subdirs
+                for f in pp_files(origin, simulation, subdir)]
+    if Path(output).exists():
+        try:
+            index = PPIndex.load(output, files, logging=logging)
+        except (OSError, ValueError, KeyError) as err:
+            print(f'Rebuilding {output} ({err})')
+            index = PPIndex(files, logging=logging)
+    else:
+        index = PPIndex(files, logging=logging)
+    index.save(output)
+    if logging:
+        print(f'Saved {len(index)} records for {len(index.files)} files to {output} ({os.path.getsize(output)/1e6:.1f}MB)')
+    return index
+
+
+def write_pp(path, records):
+    """
+    Write a simple (unpacked, big endian, 32 bit) PP file from a list of
+    (ints, reals, data) where ints and reals are partial headers as dictionaries
+    of word position to value. Only for testing.
+    """
+    with open(path, 'wb') as fh:
+        for ints, reals, data in records:
+            hi = np.zeros(NINTS, dtype='>i4')
+            hr = np.zeros(NREALS, dtype='>f4')
+            for k, v in ints.items():
+                hi[k] = v
+            for k, v in reals.items():
+                hr[k] = v
+            hi[LBROW], hi[LBNPT] = data.shape
+            hi[LBLREC] = data.size
+            body = np.asarray(data, dtype='>f4').tobytes()
+            for block in (hi.tobytes() + hr.tobytes(), body):
+                marker = np.array([len(block)], dtype='>i4').tobytes()
+                fh.write(marker + block + marker)
+
+
+def test_index():
+    """
+    Index two synthetic PP files, and check that records are found and read
+    """
+    import os
+    import tempfile
+    records = []
+    expected = {}
+    for day in (1, 2, 3):
+        for level in (850., 500.):
+            data = np.full((3, 4), day*1000 + level, dtype=np.float32)
+            data[0, 0] = -1.0e30
+            t1 = {LBYR:1980, LBYR+1:1, LBYR+2:day, LBTIM:1, LBUSER4:16203, LBUSER7:1}
+            records.append((t1, {BLEV:level, BMDI:-1.0e30, BMKS:1.0}, data))
+            expected[(day, level)] = data
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [os.path.join(tmp, 'a.pp'), os.path.join(tmp, 'b.pp')]
+        write_pp(files[0], records[:4])
+        write_pp(files[1], records[4:])
+        index = PPIndex(files)
+        assert len(index) == 6
+        assert len(index.select(16203, 1)) == 6 and len(index.select(16202)) == 0
+        times = [(1980, 1, day, 0, 0) for day in (1, 2, 3)]
+        grid = index.lookup(index.select(16203), times, [500., 850.])
+        assert grid.shape == (3, 2)
+        plan = RecordPlan(index.take(grid.ravel()), np.arange(6).reshape(3, 2))
+        handles = {}
+        for i, day in enumerate((1, 2, 3)):
+            values = plan.read(i, handles)
+            assert values.shape == (2, 3, 4)
+            assert np.ma.allequal(values[1], expected[(day, 850.)])
+            assert values.mask[0, 0, 0]
+        for fh in handles.values():
+            fh.close()
+        # ambiguous (both levels at each time) and missing lookups fail
+        assert index.lookup(index.select(16203), times) is None
+        assert index.lookup(index.select(16203), times, [700.]) is None
+
+        # store, and reload just one file, then change the other and reload both
+        store = os.path.join(tmp, 'index.npz')
+        index.save(store)
+        one = PPIndex.load(store, files[1:])
+        assert len(one) == 2 and one.files == files[1:]
+        assert np.ma.allequal(one.read(0), index.read(4))
+        write_pp(files[0], records[:2])
+        both = PPIndex.load(store, files)
+        assert len(both) == 4
+        summary = both.file_summary()
+        assert summary[files[0]]['records'] == 2 and summary[files[1]]['last'] == (1980, 1, 3, 0, 0)
+        assert summary[files[0]]['first'] == (1980, 1, 1, 0, 0) and summary[files[0]]['stash'] == {16203}
+        # loading everything still notices the changed file
+        assert len(PPIndex.load(store)) == 4
+        grid = both.lookup(both.select(16203), [times[0], times[2]], [500., 850.])
+        assert np.ma.allequal(both.read(grid[1, 1]), expected[(3, 850.)])
+
+        # split by STASH code and copy a group out
+        other = [({**ints, LBUSER4: 3236}, reals, data) for ints, reals, data in records[:2]]
+        write_pp(files[1], other + records[4:])
+        mixed = PPIndex(files)
+        groups = mixed.stash_groups()
+        assert [len(g) for g in groups] == [4, 2]
+        assert len(mixed.stash_groups(max_bytes=10**6)) == 1
+        assert mixed.group_key(groups[1]) == 'stash:1:3236'
+        assert mixed.group_key(np.arange(len(mixed))) == 'stash:1:3236,1:16203'
+        subset = PPIndex(mixed.extract(groups[1], tmp))
+        assert len(subset) == 2 and set(subset.ints[:, LBUSER4]) == {3236}
+        assert np.ma.allequal(subset.read(1), mixed.read(groups[1][1]))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['build']:
+        # python ppindex.py build origin output simulation[,simulation] subdir[,subdir]
+        origin, output, simulations, subdirs = sys.argv[2:6]
+        build_store(origin, simulations.split(','), subdirs.split(','), output)
+        sys.exit()
+    test_index()
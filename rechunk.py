@@ -0,0 +1,128 @@
+import tempfile
+from time import time
+import numpy as np
+import cf
+
+# Default ceiling (in bytes) for holding a rechunking buffer in memory, beyond
+# which we fall back to a memory-mapped scratch array.
+DEFAULT_MEMORY_LIMIT = 4e9
+
+
+def _buffer(shape, dtype, memory_limit, scratch_dir):
+    """
+    Get an empty buffer for the data, either in memory, or if it won't fit within
+    the memory limit, as a memory map onto an anonymous scratch file (which
+    disappears when the buffer is released).
+    """
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if nbytes <= memory_limit:
+        return np.empty(shape, dtype=dtype), 'memory'
+    scratch = tempfile.TemporaryFile(dir=scratch_dir)
+    return np.memmap(scratch, dtype=dtype, mode='w+', shape=tuple(shape)), 'memmap'
+
+
+def _fill_from_plan(buffer, data, plan, fill):
+    """
+    Fill the buffer record by record from a PP record plan (see ppindex),
+    checking that the plan agrees with cf about the first record from each of
+    the PP files involved (the records we check go straight into the buffer).
+    Returns False as soon as a check fails, leaving the buffer to be refilled.
+    """
+    # the first leading index which uses each file
+    firsts = {}
+    for i in range(buffer.shape[0]):
+        for fileid in np.atleast_1d(plan.index.file[plan.grid[i]]).flat:
+            firsts.setdefault(int(fileid), i)
+    checks = set(firsts.values())
+    handles = {}
+    try:
+        for i in sorted(checks):
+            values = plan.read(i, handles)
+            if not np.ma.allclose(values, data[i].array.reshape(values.shape)):
+                return False
+            buffer[i] = np.ma.filled(values, fill)
+        for i in range(buffer.shape[0]):
+            if i not in checks:
+                buffer[i] = np.ma.filled(plan.read(i, handles), fill)
+    finally:
+        for fh in handles.values():
+            fh.close()
+    return True
+
+
+def rechunk_field(f, chunk_shape, memory_limit=DEFAULT_MEMORY_LIMIT, scratch_dir=None, logging=False, plan=None):
+    """
+    Reading pp data in anything other than whole records is horrific: each chunk
+    which spans records causes those records to be read (and unpacked) again, so
+    we effectively read the entire data many times and slice in memory.
+    Instead, read each record (leading dimension slice) of the field exactly
+    once into a buffer, and replace the field data with that buffer, so that
+    cf.write can stream the target chunks (<chunk_shape>) straight into
+    the final compressed file.
+    The buffer is held in memory if it fits within <memory_limit> bytes,
+    otherwise it is memory mapped onto scratch space in <scratch_dir>
+    (default, the system temporary directory).
+    If we have a plan of where each record is in the PP files (see ppindex), 
+    we read the records directly from that, otherwise (or if the plan turns out
+    not to match the field) we read them through cf.
+    Returns the field and a dictionary of statistics about the operation.
+    """
+    e1 = time()
+    data = f.data
+    fill = f.fill_value(default='netCDF')
+    buffer, mode = _buffer(data.shape, data.dtype, memory_limit, scratch_dir)
+    nrecords = data.shape[0]
+    source = 'cf'
+    if plan is not None:
+        try:
+            if _fill_from_plan(buffer, data, plan, fill):
+                source = 'ppindex'
+        except (OSError, NotImplementedError, ValueError) as err:
+            if logging:
+                print(f'Cannot read records from the PP index ({err}), using cf')
+    if source == 'cf':
+        for i in range(nrecords):
+            buffer[i:i+1] = np.ma.filled(data[i].array, fill)
+    e2 = time()
+
+    # missing data is carried through the buffer as the fill value, so make
+    # sure that it is declared as such when written out.
+    if f.get_property('_FillValue', None) is None:
+        f.set_property('_FillValue', fill)
+    axes = f.get_data_axes()
+    f.set_data(cf.Data(buffer, units=f.Units, fill_value=fill, copy=False), axes=axes, copy=False)
+    # yes, the method has the wrong name
+    f.data.nc_set_hdf5_chunksizes(chunk_shape)
+
+    stats = {'mode': mode,
+             'source': source,
+             'records': nrecords,
+             'bytes': int(buffer.nbytes),
+             'seconds': e2-e1}
+    if logging:
+        rate = stats['bytes']/max(stats['seconds'], 1e-9)/1e6
+        print(f"Rechunked {nrecords} records ({stats['bytes']/1e6:.1f}MB) via {mode} buffer from {source} in {stats['seconds']:.1f}s ({rate:.1f}MB/s)")
+    return f, stats
+
+
+def test_rechunk(memory_limit=DEFAULT_MEMORY_LIMIT):
+    """
+    Check that rechunking preserves the data and the missing values
+    (use a memory_limit of 0 to test the memory mapped option)
+    """
+    f = cf.example_field(0)
+    f[0, 0] = cf.masked
+    expected = f.array
+    f, stats = rechunk_field(f, [1, 8], memory_limit=memory_limit, logging=True)
+    with tempfile.NamedTemporaryFile(suffix='.nc') as fp:
+        cf.write(f, fp.name, compress=4, shuffle=True)
+        g = cf.read(fp.name)[0]
+        assert g.data.nc_hdf5_chunksizes() == (1, 8)
+        result = g.array
+    assert np.ma.allequal(result, expected)
+    assert result.mask[0, 0]
+
+
+if __name__ == "__main__":
+    test_rechunk()
+    test_rechunk(memory_limit=0)
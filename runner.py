@@ -1,5 +1,9 @@
+import json
+import os
+import sys
 from common_concept import CommonConcepts
 from pp_to_nice_netcdf import pp2nc_from_config
+from workqueue import WorkQueue, run_worker
 
 #
 # You need to edit this file to use YOUR config file 
@@ -10,14 +14,47 @@ CONFIG_FILE = 'n1280_processing_v1.json'
 S3_TARGET = 'hpos'
 S3_BUCKET = 'bnl'
 
+#
+# To have a fixed pool of workers share out the tasks (rather than one slurm array
+# task per configuration task), set QUEUE_DIR to a directory on a shared file system
+# (or run "python runner.py queue <dir>"). Each worker keeps taking tasks until there
+# are none left. Tasks which fail are retried (up to QUEUE_ATTEMPTS times), and tasks
+# held by a worker which has been silent for QUEUE_STALE seconds are handed on.
+# Use "python workqueue.py status <dir>" to see progress.
+#
+# Outputs already finished by an earlier run of a task (according to its manifest) are
+# skipped, add --force to the command line to redo them.
+#
+
+QUEUE_DIR = None
+QUEUE_STALE = 900
+QUEUE_ATTEMPTS = 3
+
 #
 # Change nothing below here
 #
 
-cc = CommonConcepts()
-task_number = int(os.environ['SLURM_ARRAY_TASK_ID'])
-config_file = CONFIG_FILE
-print(f"Using task {task_number} from {config_file}")
-pp2nc_from_config(cc, config_file, task_number, 
-                target = S3_TARGET, bucket=S3_BUCKET,
-                logging=True, dummy_run=False)
\ No newline at end of file
+if __name__ == "__main__":
+    # (the guard is needed so that parallel writer processes can import this safely)
+    cc = CommonConcepts()
+    config_file = CONFIG_FILE
+    force = '--force' in sys.argv
+    args = [a for a in sys.argv[1:] if a != '--force']
+    queue_dir = (args[1:2] or [QUEUE_DIR])[0] if args[0:1] == ['queue'] else QUEUE_DIR
+    if queue_dir:
+        with open(config_file) as f:
+            ntasks = len(json.load(f)['tasks'])
+        queue = WorkQueue(queue_dir, stale_after=QUEUE_STALE, max_attempts=QUEUE_ATTEMPTS)
+        queue.populate(ntasks)
+        print(f"Working on tasks from {config_file} via {queue_dir}: {queue.counts()}")
+        worker = f"{os.uname().nodename}:{os.getpid()}:{os.environ.get('SLURM_ARRAY_TASK_ID', os.environ.get('SLURM_PROCID', '-'))}"
+        # (check stops the task if our claim on it is handed on to another worker)
+        run_worker(queue, lambda task_number, check: pp2nc_from_config(cc, config_file, task_number,
+                                    target = S3_TARGET, bucket=S3_BUCKET,
+                                    logging=True, dummy_run=False, force=force, check=check), worker=worker)
+    else:
+        task_number = int(os.environ['SLURM_ARRAY_TASK_ID'])
+        print(f"Using task {task_number} from {config_file}")
+        pp2nc_from_config(cc, config_file, task_number, 
+                        target = S3_TARGET, bucket=S3_BUCKET,
+                        logging=True, dummy_run=False, force=force)
@@ -1,7 +1,21 @@
 from pathlib import Path
+import functools
 import json
+import os
+import re
+import threading
+import certifi
+import urllib3
 from minio import Minio
 
+# Process wide registry of clients (keyed by alias or credentials), the
+# connection pool they share, and the buckets we know exist.
+POOL_SIZE = 32
+_pool = None
+_clients = {}
+_buckets = set()
+_lock = threading.Lock()
+
 def get_user_config(target, location='.mc/config.json'):
     """
     Obtain credentials from user configuration file
@@ -16,57 +30,243 @@ def get_user_config(target, location='.mc/config.json'):
         raise ValueError(f'Minio target [{target}] not found in {jfile}')
 
 
+def _http_pool():
+    """
+    The urllib3 connection pool shared by all our clients, sized so that
+    concurrent uploads (upload threads x parallel parts) can all keep their
+    connections alive. Set POOL_SIZE before the first client is created
+    to change it.
+    """
+    global _pool
+    if _pool is None:
+        timeout = 300
+        _pool = urllib3.PoolManager(
+            timeout=urllib3.Timeout(connect=timeout, read=timeout),
+            maxsize=POOL_SIZE,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+            retries=urllib3.Retry(total=5, backoff_factor=0.2,
+                                  status_forcelist=[500, 502, 503, 504])
+            )
+    return _pool
+
+
+def size_pool(connections):
+    """
+    Make sure the shared connection pool will allow at least this many
+    concurrent connections per host (only effective before the first
+    client is created).
+    """
+    global POOL_SIZE
+    POOL_SIZE = max(POOL_SIZE, int(connections))
+
+
+def client_from_credentials(credentials, secure=None):
+    """
+    Get a Minio client for the credentials (an alias entry from the
+    user configuration file). Clients are cached for the life of the process
+    and share one connection pool. If secure is not given, it is determined 
+    from the url in the credentials.
+    """
+    if secure is None:
+        secure = credentials['url'].startswith('https')
+    api = {'endpoint':'url','access_key':'accessKey','secret_key':'secretKey'}
+    try:
+        kw = {k:credentials[v] for k,v in api.items()}
+    except KeyError as error:
+        raise KeyError(f"Cannot find {error} in credentials supplied")
+    key = (kw['endpoint'], kw['access_key'], secure)
+    with _lock:
+        if key not in _clients:
+            kw['secure'] = secure
+            endpoint = kw['endpoint']
+            slashes = endpoint.find('//')
+            if slashes > -1:
+                kw['endpoint'] = endpoint[slashes+2:]
+            _clients[key] = Minio(**kw, http_client=_http_pool())
+        return _clients[key]
+
+
 def get_client(alias):
     """
     Get Minio client from the configuration alias, and patch the 
-    client with that alias name
+    client with that alias name. The configuration is only read
+    once, and the client reused, for each alias.
     """
-    credentials = get_user_config(alias)
-    secure = False
-    if credentials['url'].startswith('https'):
-        secure = True
+    with _lock:
+        client = _clients.get(alias)
+    if client is None:
+        credentials = get_user_config(alias)
+        client = client_from_credentials(credentials)
+        # nasty monkey patch, but I want to carry this around
+        client.alias_name = alias
+        with _lock:
+            _clients[alias] = client
+    return client
+
+
+def ensure_bucket(client, bucket):
+    """
+    Make the bucket if it does not exist. We remember buckets we know
+    to exist, so this is only a round trip the first time.
+    """
+    key = (id(client), bucket)
+    if key in _buckets:
+        return
     try:
-        api = {'endpoint':'url','access_key':'accessKey','secret_key':'secretKey'}
-        try:
-            kw = {k:credentials[v] for k,v in api.items()}
-        except KeyError:
-            raise KeyError(f"Cannot find {v} in credentials supplied")
-        kw['secure'] = secure
-        endpoint = kw['endpoint']
-        slashes = endpoint.find('//')
-        if slashes > -1:
-            kw['endpoint'] = endpoint[slashes+2:]
-        client = Minio(**kw) 
+        found = client.bucket_exists(bucket)
     except:
-        raise 
-    # nasty monkey patch, but I want to carry this around
-    client.alias_name = alias
-    return client
+        print('** CHECK ENDPOINT ADDRESS and SECURE OPTION')
+        raise
+    if not found:
+        client.make_bucket(bucket)
+        print('Created bucket', bucket)
+    with _lock:
+        _buckets.add(key)
+
+
+def bucket_made(client, bucket):
+    """
+    Record that we have made a bucket ourselves
+    """
+    with _lock:
+        _buckets.add((id(client), bucket))
+
+
+# Characters which make a pattern segment a wildcard
+WILDCARDS = '*?['
+
+
+def _translate(segment):
+    """
+    Translate one (slash free) glob segment into a regular expression
+    """
+    i, n, out = 0, len(segment), []
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == '*':
+            while i < n and segment[i] == '*':
+                i += 1
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and segment[j] in '!^':
+                j += 1
+            if j < n and segment[j] == ']':
+                j += 1
+            while j < n and segment[j] != ']':
+                j += 1
+            if j >= n:
+                out.append('\\[')
+            else:
+                chars = segment[i:j].replace('\\', '\\\\')
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                out.append(f'[{chars}]')
+                i = j + 1
+        else:
+            out.append(re.escape(c))
+    return ''.join(out)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_glob(pattern):
+    """
+    Compile a glob pattern for object keys into a regular expression for the 
+    whole key. * ? and [...] do not match across /, while ** as a whole segment
+    matches any number of "directories" (including none), or everything
+    when it is the last segment.
+    """
+    segments = pattern.split('/')
+    out = []
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == '**':
+            out.append('.*' if last else '(?:[^/]*/)*')
+        else:
+            out.append(_translate(segment) + ('' if last else '/'))
+    return re.compile(''.join(out) + '\\Z', re.DOTALL)
+
+
+def _is_wild(segment):
+    return any(c in segment for c in WILDCARDS)
+
+
+def _literal(segment):
+    """ The literal start of a segment, before the first wildcard """
+    for i, c in enumerate(segment):
+        if c in WILDCARDS:
+            return segment[:i]
+    return segment
+
+
+def _walk(client, bucket, base, segments, matcher):
+    """
+    Yield the objects below base matching the remaining pattern segments,
+    listing one level at a time (with the server doing the prefix matching)
+    so that we only descend into "directories" which can match.
+    """
+    for i, segment in enumerate(segments):
+        if _is_wild(segment):
+            break
+    else:
+        # no wildcards left, so this can only be one object
+        name = base + '/'.join(segments)
+        for o in client.list_objects(bucket, prefix=name):
+            if o.object_name == name:
+                yield o
+        return
+    base += ''.join(f'{s}/' for s in segments[:i])
+    if segment == '**':
+        # everything below base is a candidate
+        for o in client.list_objects(bucket, prefix=base or None, recursive=True):
+            if matcher.match(o.object_name):
+                yield o
+        return
+    last = i == len(segments) - 1
+    here = re.compile(_translate(segment) + ('\\Z' if last else '/\\Z'))
+    prefix = base + _literal(segment)
+    for o in client.list_objects(bucket, prefix=prefix or None):
+        name = o.object_name[len(base):]
+        if last:
+            if not o.is_dir and here.match(name):
+                yield o
+        elif o.is_dir and here.match(name):
+            yield from _walk(client, bucket, o.object_name, segments[i+1:], matcher)
+
 
 def lswild(client, bucket, pattern='*', objects=False):
     """ 
-    Do an ls on a bucket visible on the minio client which matches pattern
-    This isn't quite a perfect glob! So be careful. Also, we're being cunning
-    in trying to get the server to try and do some of the matching, at least
-    for simple cases.
-    If objects is False, return just names, oterwise return the objects
+    Generate a listing of a bucket visible on the minio client which matches
+    a glob pattern for the whole key (see compile_glob). The server does the 
+    work of matching the literal parts of the pattern, and we only list within
+    "directories" which can match. A pattern ending in / lists that directory.
+    If objects is False, yield just names, otherwise yield the objects
     for later processing
     """
-    
-    asterix = pattern.find('*')
-    
-    if asterix > 0:
-        prefix = pattern[0:asterix]
-        pattern = pattern[asterix:]
-    else:
-        prefix = None
-    
-    objects = client.list_objects(bucket, prefix=prefix)
-    
-    if objects:
-        olist = [o for o in objects if Path(o.object_name).match(pattern)]
-        return olist
-    else:
-        object_names = [o.object_name for o in objects]
-        flist = [p for p in object_names if Path(p).match(pattern)]
-        return flist
+    if pattern == '' or pattern.endswith('/'):
+        pattern += '*'
+    matcher = compile_glob(pattern)
+    for o in _walk(client, bucket, '', pattern.split('/'), matcher):
+        yield o if objects else o.object_name
+
+
+def test_glob():
+    """ 
+    Check the glob translation 
+    """
+    cases = [('*.nc', 'a.nc', True), ('*.nc', 'd/a.nc', False),
+             ('d/*/x?.nc', 'd/e/x1.nc', True), ('d/*/x?.nc', 'd/e/f/x1.nc', False),
+             ('d/**/x.nc', 'd/x.nc', True), ('d/**/x.nc', 'd/e/f/x.nc', True),
+             ('d/**', 'd/e/f/x.nc', True), ('d/**', 'e/x.nc', False),
+             ('[ab]*.nc', 'b1.nc', True), ('[!ab]*.nc', 'b1.nc', False),
+             ('a[.nc', 'a[.nc', True), ('a+b.nc', 'a+b.nc', True)]
+    for pattern, name, expected in cases:
+        assert bool(compile_glob(pattern).match(name)) == expected, (pattern, name)
+
+
+if __name__ == "__main__":
+    test_glob()
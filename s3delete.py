@@ -0,0 +1,163 @@
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time, strftime
+import click
+from minio.deleteobjects import DeleteObject
+
+# S3 allows at most this many keys in one delete request
+DELETE_BATCH = 1000
+
+
+class DeleteStats:
+    """
+    Running totals for a set of objects: how many, how big, and how they
+    are spread over prefixes (the first depth "directories" of each name).
+    """
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.count = 0
+        self.bytes = 0
+        self.prefixes = Counter()
+        self.volumes = Counter()
+
+    def add(self, name, size):
+        self.count += 1
+        self.bytes += size
+        prefix = '/'.join(name.split('/')[:-1][:self.depth])
+        prefix = prefix + '/' if prefix else '/'
+        self.prefixes[prefix] += 1
+        self.volumes[prefix] += size
+
+    def report(self, fmt_size, top=10):
+        """ A compact description, with the largest prefixes by count """
+        lines = [f'{self.count} objects ({fmt_size(self.bytes)}) in {len(self.prefixes)} prefixes']
+        for prefix, n in self.prefixes.most_common(top):
+            lines.append(f'  {prefix:<40} {n:>10} {fmt_size(self.volumes[prefix]):>10}')
+        if len(self.prefixes) > top:
+            lines.append(f'  ... and {len(self.prefixes)-top} more prefixes')
+        return lines
+
+
+def _send(client, bucket, batch):
+    """
+    Send one batch of (name, size) for deletion, returning the errors
+    """
+    try:
+        return list(client.remove_objects(bucket, [DeleteObject(name) for name, size in batch]))
+    except Exception as err:
+        # the whole request failed, so record it against every name
+        return [_Failed(name, type(err).__name__, str(err)) for name, size in batch]
+
+
+class _Failed:
+    """ Looks enough like a minio DeleteError for our purposes """
+    def __init__(self, name, code, message):
+        self.name, self.code, self.message = name, code, message
+
+
+def bulk_delete(client, bucket, objects, threads=4, batch_size=DELETE_BATCH, report=None, progress=True):
+    """
+    Delete (name, size) pairs from bucket, streaming them into batches of
+    batch_size keys which are sent concurrently from a pool of threads. Errors
+    are written (as json lines) to the report file (which is only created
+    if there are errors). Returns a dictionary with the deleted names, the
+    numbers deleted and failed, the bytes deleted, the time taken and the report.
+    """
+    deleted, failed, volume = [], 0, 0
+    errors = None
+    e1 = time()
+
+    def collect(done):
+        nonlocal failed, volume, errors
+        for future in done:
+            batch = pending.pop(future)
+            bad = {}
+            for error in future.result():
+                bad[error.name] = error
+            for name, size in batch:
+                if name in bad:
+                    if errors is None:
+                        errors = open(report, 'w')
+                    error = bad[name]
+                    errors.write(json.dumps({'name':name, 'code':error.code, 'message':error.message})+'\n')
+                    failed += 1
+                else:
+                    deleted.append(name)
+                    volume += size
+            if progress:
+                click.echo(f'\rDeleted {len(deleted)} objects, {failed} failed', nl=False)
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        batch = []
+        for item in objects:
+            batch.append(item)
+            if len(batch) == batch_size:
+                pending[pool.submit(_send, client, bucket, batch)] = batch
+                batch = []
+                # don't let the listing run too far ahead of the deletes
+                if len(pending) >= 2*threads:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+        if batch:
+            pending[pool.submit(_send, client, bucket, batch)] = batch
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+    if progress:
+        click.echo('')
+    if errors is not None:
+        errors.close()
+    return {'deleted': deleted, 'ndeleted': len(deleted), 'failed': failed, 'bytes': volume,
+            'seconds': time()-e1, 'report': report if failed else None}
+
+
+def default_report(bucket):
+    """ Where we put the errors from a delete if we're not told """
+    return f'rm-errors-{bucket}-{strftime("%Y%m%dT%H%M%S")}.jsonl'
+
+
+def test_bulk_delete(target="local", bucket="test"):
+    """
+    Delete in small batches on a real (or fake) S3 target, with one batch
+    failing, and check the stats and error report.
+    """
+    import io
+    import os
+    import tempfile
+    from s3core import get_client, ensure_bucket
+    client = get_client(target)
+    ensure_bucket(client, bucket)
+    names = [f'rmtest/{d}/f{i}.nc' for d in 'ab' for i in range(5)]
+    for name in names:
+        client.put_object(bucket, name, io.BytesIO(b'xy'), 2)
+    stats = DeleteStats(depth=2)
+    for name in names:
+        stats.add(name, 2)
+    assert stats.prefixes == {'rmtest/a/': 5, 'rmtest/b/': 5}
+
+    class Flaky:
+        """ Fail the batch containing the first b file """
+        def remove_objects(self, bucket, delete_list):
+            if any(d.name == 'rmtest/b/f0.nc' for d in delete_list):
+                raise ConnectionError('dropped')
+            return client.remove_objects(bucket, delete_list)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        report = os.path.join(tmp, 'errors.jsonl')
+        result = bulk_delete(Flaky(), bucket, ((n, 2) for n in names), threads=2, batch_size=3,
+                             report=report, progress=False)
+        # batches are a0-a2, a3-b0, b1-b3, b4
+        expected = ['rmtest/a/f3.nc', 'rmtest/a/f4.nc', 'rmtest/b/f0.nc']
+        assert result['ndeleted'] == 7 and result['failed'] == 3, result
+        assert result['bytes'] == 14
+        with open(report) as rfile:
+            assert sorted(json.loads(line)['name'] for line in rfile) == expected
+    left = sorted(o.object_name for o in client.list_objects(bucket, prefix='rmtest/', recursive=True))
+    assert left == expected
+    bulk_delete(client, bucket, ((n, 2) for n in left), progress=False)
+
+
+if __name__ == "__main__":
+    test_bulk_delete()
@@ -0,0 +1,198 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from time import time
+import click
+from minio.commonconfig import CopySource, ComposeSource
+from minio.deleteobjects import DeleteObject
+from s3delete import DELETE_BATCH
+
+# Objects bigger than this can't be copied in one request, and are composed from parts
+COPY_LIMIT = 5*1024**3
+
+
+class MoveJournal:
+    """
+    A journal (json lines) of a move in progress, so that an interrupted move
+    can be resumed. We record each source once its copy has been verified, and
+    each batch of sources once they have been deleted.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.copied = {}
+        self.deleted = set()
+        if self.path.exists():
+            with open(self.path) as jfile:
+                for line in jfile:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a partial last line from an interruption
+                        continue
+                    if entry['event'] == 'copied':
+                        self.copied[entry['source']] = entry
+                    else:
+                        self.deleted.update(entry['sources'])
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, 'a')
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry)+'\n')
+        self._file.flush()
+
+    def record_copy(self, source, target, size):
+        entry = {'event':'copied', 'source':source, 'target':target, 'size':size}
+        self.copied[source] = entry
+        self._write(entry)
+
+    def record_delete(self, sources):
+        self.deleted.update(sources)
+        self._write({'event':'deleted', 'sources':sources})
+
+    def finish(self):
+        """ Close and remove the journal, the move is complete """
+        self._file.close()
+        os.remove(self.path)
+
+    def close(self):
+        self._file.close()
+
+
+def copy_verified(client, source_bucket, o, target_bucket, target):
+    """
+    Server side copy of the object o (as listed) to target, composing it from
+    parts if it is too big for a single copy. The source must still have the
+    etag we listed, and the copy is verified by size, and by etag too for single
+    copies of objects which were not uploaded in parts (multipart objects, with
+    etags ending -N, and composed copies get a new etag). Returns the target stat.
+    """
+    etag = o.etag.strip('"') if o.etag else None
+    if o.size > COPY_LIMIT:
+        client.compose_object(target_bucket, target,
+                    [ComposeSource(source_bucket, o.object_name, match_etag=etag)])
+    else:
+        result = client.copy_object(target_bucket, target,
+                    CopySource(source_bucket, o.object_name, match_etag=etag))
+    stat = client.stat_object(target_bucket, target)
+    if stat.size != o.size:
+        raise RuntimeError(f'Copy of {o.object_name} to {target} has size {stat.size} not {o.size}')
+    if o.size <= COPY_LIMIT and etag and '-' not in etag and result.etag and result.etag.strip('"') != etag:
+        raise RuntimeError(f'Copy of {o.object_name} to {target} has etag {result.etag} not {etag}')
+    return stat
+
+
+def move_objects(client, source_bucket, moves, target_bucket=None, threads=8, journal=None, progress=True):
+    """
+    Move objects (server side), where moves is a list of (object, target name) pairs.
+    The copies are done concurrently in a pool of threads, and then the sources
+    of the verified copies are removed in batches. If a journal file is given
+    we can resume an interrupted move, the journal is removed when we are done.
+    Returns a summary dictionary (including any failures, which are left in place).
+    """
+    if target_bucket is None:
+        target_bucket = source_bucket
+    journal = MoveJournal(journal) if journal is not None else None
+    done = journal.copied if journal else {}
+    deleted = journal.deleted if journal else set()
+    todo = [(o, t) for o, t in moves if o.object_name not in done and o.object_name not in deleted]
+    if journal and len(todo) < len(moves):
+        click.echo(f'Resuming: {len(moves)-len(todo)} of {len(moves)} objects already copied')
+
+    copied, failed = [], []
+    volume = sum(o.size for o, t in todo)
+    e1 = time()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {pool.submit(copy_verified, client, source_bucket, o, target_bucket, t): (o, t)
+                    for o, t in todo}
+        with click.progressbar(length=volume, label='Copying', hidden=not progress) as bar:
+            for future in as_completed(futures):
+                o, t = futures[future]
+                try:
+                    stat = future.result()
+                except Exception as err:
+                    failed.append((o.object_name, str(err)))
+                else:
+                    copied.append((o, t, stat))
+                    if journal:
+                        journal.record_copy(o.object_name, t, o.size)
+                bar.update(o.size)
+    e2 = time()
+
+    # we can delete everything we (now or previously) copied, but not what failed
+    verified = set(done) | set(o.object_name for o, t, s in copied)
+    sources = list(dict.fromkeys(o.object_name for o, t in moves
+                    if o.object_name in verified and o.object_name not in deleted))
+    removed = []
+    for i in range(0, len(sources), DELETE_BATCH):
+        batch = sources[i:i+DELETE_BATCH]
+        errors = list(client.remove_objects(source_bucket, [DeleteObject(s) for s in batch]))
+        bad = set(error.name for error in errors)
+        for error in errors:
+            failed.append((error.name, f'delete failed: {error.message}'))
+        batch = [s for s in batch if s not in bad]
+        removed += batch
+        if journal:
+            journal.record_delete(batch)
+    e3 = time()
+
+    moved_bytes = sum(o.size for o, t, s in copied)
+    summary = {'moved': len(copied), 'bytes': moved_bytes, 'removed': len(removed),
+               'failed': failed, 'copied': copied, 'removed_names': removed,
+               'copy_seconds': e2-e1, 'delete_seconds': e3-e2,
+               'rate': moved_bytes/max(e2-e1, 1e-9)}
+    if journal:
+        if failed:
+            journal.close()
+        else:
+            journal.finish()
+    return summary
+
+
+def test_move(target="local", bucket="test"):
+    """
+    Move some objects between prefixes on a real (or fake) S3 target,
+    interrupting the first attempt and resuming from the journal.
+    """
+    import io
+    import tempfile
+    from s3core import get_client, ensure_bucket
+    client = get_client(target)
+    ensure_bucket(client, bucket)
+    for i in range(5):
+        client.put_object(bucket, f'mvtest/src/f{i}.nc', io.BytesIO(b'x'*(i+1)), i+1)
+    objects = list(client.list_objects(bucket, prefix='mvtest/src/'))
+    moves = [(o, o.object_name.replace('/src/', '/dst/')) for o in objects]
+    with tempfile.TemporaryDirectory() as tmp:
+        jfile = Path(tmp)/'mv.jsonl'
+        # pretend we were interrupted after copying the first two
+        journal = MoveJournal(jfile)
+        for o, t in moves[:2]:
+            client.copy_object(bucket, t, CopySource(bucket, o.object_name))
+            journal.record_copy(o.object_name, t, o.size)
+        journal.close()
+        summary = move_objects(client, bucket, moves, journal=jfile, progress=False)
+        assert summary['moved'] == 3 and summary['removed'] == 5, summary
+        assert not summary['failed']
+        assert not jfile.exists()
+    assert list(client.list_objects(bucket, prefix='mvtest/src/')) == []
+    dst = sorted(o.object_name for o in client.list_objects(bucket, prefix='mvtest/dst/'))
+    assert dst == [f'mvtest/dst/f{i}.nc' for i in range(5)]
+    list(client.remove_objects(bucket, [DeleteObject(d) for d in dst]))
+
+    # an object uploaded in parts gets a new etag when it is copied
+    from upload import multipart_upload
+    from minio.helpers import MIN_PART_SIZE
+    with tempfile.NamedTemporaryFile() as fp:
+        fp.write(os.urandom(MIN_PART_SIZE+1000))
+        fp.flush()
+        multipart_upload(client, bucket, 'mvtest/src/parts.nc', fp.name, MIN_PART_SIZE)
+    objects = list(client.list_objects(bucket, prefix='mvtest/src/'))
+    assert objects[0].etag.strip('"').endswith('-2')
+    summary = move_objects(client, bucket, [(objects[0], 'mvtest/dst/parts.nc')], progress=False)
+    assert summary['moved'] == 1 and not summary['failed'], summary
+    list(client.remove_objects(bucket, [DeleteObject('mvtest/dst/parts.nc')]))
+
+
+if __name__ == "__main__":
+    test_move()
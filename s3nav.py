@@ -1,10 +1,14 @@
 from pathlib import Path, PurePath
+import csv
+import json
+import sys
 from minio.deleteobjects import DeleteObject
 from time import time
 import click
 from skin import _e, _i, _p
-from pfs import PsuedoFileSystem, fmt_date, fmt_size, rm
+from pfs import PsuedoFileSystem, fmt_date, fmt_size, rm as rm_objects
 from s3core import get_client, lswild
+from usage import UsageIndex
 
 
 def _handle_argument(target):
@@ -23,56 +27,83 @@ def _handle_argument(target):
 
 
 
-def do_rm(client, bucket, pattern):
+def do_rm(client, bucket, pattern, dry_run=False, threads=4, report=None):
     """ 
     Wild card removal of files in object store.
     Be careful
     """
-    files = lswild(client, bucket, pattern, objects=True)
-    if len(files) == 0:
-        click.echo(_i(f'Nothing to delete matching [{pattern}] found in [{bucket}] in [{client.alias_name}]'))
-        return
-    rm(client, bucket, files)
+    files = lambda: lswild(client, bucket, pattern, objects=True)
+    rm_objects(client, bucket, files, dry_run=dry_run, threads=threads, report=report)
 
-def do_ls(client, bucket, pattern, columns=None, size=None, date=None):
+def do_ls(client, bucket, pattern, size=False, date=False, summary=False, fmt=None, output=None):
     """
-    Wild card listing of files in object store
+    Wild card listing of files in object store, in one pass over the listing, 
+    with each row written as it arrives. The name column grows to fit the 
+    longest name seen so far, the size and date columns are fixed width.
+    fmt can be "json" (one object per line) or "csv" (with a header) for 
+    machine readable output, which always includes the size, date and etag.
+    If summary is set the count and volume are reported at the end (on
+    stderr for machine readable output).
     """
-    files = lswild(client, bucket, pattern)
-    if size is not None or date is not None:
-        columns = 1
-        d = ['Object Name']
-        if size:
-            d.append('Size')
-        if date:
-            d.append('Last Modified')
-        data = [d]
-        m = [len(x) for x in d]
-        fmts = ['>' for x in d]
-        fmts[0]='<'
-        objects = lswild(client, bucket, pattern, objects=True)
-        for o in objects:
-            d = [o.object_name]
-            if size:
-                d.append(fmt_size(o.size))
-            if date:
-                d.append(fmt_date(o.last_modified))
-            data.append(d)
-            m = [max(i,len(j)) for i,j in zip(m,d)]
-        for i in range(1,len(m)):
-            m[i]+=5
-        files = [] 
-        for row in data:
-            files.append(' '.join(f"{item:{fmt}{max_len}}" for item, fmt, max_len in zip(row, fmts, m)))
-    else:
-        files = lswild(client, bucket, pattern)
+    output = output or sys.stdout
+    objects = lswild(client, bucket, pattern, objects=True)
+    if fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(['name', 'size', 'last_modified', 'etag'])
+    count, volume, width = 0, 0, 0
+    for o in objects:
+        count += 1
+        volume += o.size
+        if fmt == 'json':
+            output.write(json.dumps({'name': o.object_name, 'size': o.size, 
+                                     'last_modified': o.last_modified.isoformat(),
+                                     'etag': o.etag.strip('"') if o.etag else None})+'\n')
+        elif fmt == 'csv':
+            writer.writerow([o.object_name, o.size, o.last_modified.isoformat(),
+                             o.etag.strip('"') if o.etag else ''])
+        else:
+            row = o.object_name
+            if size or date:
+                width = max(width, len(row))
+                row = f'{row:<{width}}'
+                if size:
+                    row += f'  {fmt_size(o.size):>10}'
+                if date:
+                    row += f'  {fmt_date(o.last_modified):>23}'
+            print(row, file=output)
+    if fmt is None and not count:
+        print(f'No files found matching "{pattern}" in [{bucket}] at [{client.alias_name}]', file=output)
+    if summary:
+        click.echo(_i(f'{count} files/objects matching "{pattern}" in [{bucket}] contain ') + fmt_size(volume), 
+                   err=fmt is not None)
+    return count, volume
+        
 
-    if len(files):
-        for file in files:
-            print(file)
+def do_du(client, bucket, prefix='', top=10, depth=1, growth=False, update=True, index=None):
+    """
+    Report the biggest (or fastest growing) prefixes below prefix from the 
+    usage index for the bucket, updating the index first if asked.
+    """
+    index = UsageIndex(index) if index else UsageIndex.for_bucket(client.alias_name, bucket)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    if update:
+        run = index.update(client, bucket)
+        click.echo(_i(f"Listed {run['listed']} objects in {run['seconds']:.1f}s: ") + 
+                   _e(f"{run['changed']} new or changed, {run['removed']} removed"))
+    volume, nobjects = index.get(prefix)
+    click.echo(_i(f'[{bucket}]/{prefix} contains ') + fmt_size(volume) + _i(f' in {nobjects} files/objects'))
+    if growth:
+        rows = index.growth(top, prefix, depth)
+        for p, pbytes, pobjects, dbytes, dobjects in rows:
+            click.echo(f'{p:<50} {fmt_size(pbytes):>10} {pobjects:>10}  ' + _e(f'{"+" if dbytes >= 0 else "-"}{fmt_size(abs(dbytes)):>10} {dobjects:>+8}'))
     else:
-        print(f'No files found matching "{pattern}" in [{bucket}] at [{client.alias_name}]')
-        
+        rows = index.top(top, prefix, depth)
+        for p, pbytes, pobjects in rows:
+            click.echo(f'{p:<50} {fmt_size(pbytes):>10} {pobjects:>10}')
+    index.close()
+    return rows
+
 
 @click.group()
 def cli():
@@ -80,19 +111,43 @@ def cli():
 
 @cli.command()
 @click.argument('action')
-def rm(action):
+@click.option('--dry-run', is_flag=True, help='Only summarise what would be deleted')
+@click.option('--threads', default=4, help='Number of delete requests to send at once')
+@click.option('--report', default=None, help='File for any delete errors (default rm-errors-<bucket>-<time>.jsonl)')
+def rm(action, dry_run, threads, report):
+    client, bucket, therest = _handle_argument(action)
+    do_rm(client, bucket, therest, dry_run=dry_run, threads=threads, report=report)
+
+@cli.command()
+@click.argument('action')
+@click.option('--size', is_flag=True, help='Show object sizes')
+@click.option('--date', is_flag=True, help='Show last modified dates')
+@click.option('--summary', is_flag=True, help='Report the number and volume of objects at the end')
+@click.option('--json', 'fmt', flag_value='json', help='One JSON object per line')
+@click.option('--csv', 'fmt', flag_value='csv', help='CSV with a header')
+def ls(action, size, date, summary, fmt):
     client, bucket, therest = _handle_argument(action)
-    do_rm(client, bucket, therest)
+    do_ls(client, bucket, therest, size=size, date=date, summary=summary, fmt=fmt)
 
 @cli.command()
 @click.argument('action')
-def ls(action):
+@click.option('--top', default=10, help='How many prefixes to show')
+@click.option('--depth', default=1, help='How many levels below the target to report')
+@click.option('--growth', is_flag=True, help='Show growth since the last run rather than size')
+@click.option('--update/--no-update', default=True, help='Update the index from a listing first')
+@click.option('--index', default=None, help='Usage index file (default in ~/.cache/pp2nice)')
+def du(action, top, depth, growth, update, index):
+    """ Disk usage by prefix, from a persistent index """
     client, bucket, therest = _handle_argument(action)
-    do_ls(client, bucket, therest)
+    do_du(client, bucket, therest, top=top, depth=depth, growth=growth, update=update, index=index)
 
 @cli.command()
 @click.argument('target')
-def manage(target):
+@click.option('--depth', default=None, type=int, help='Only sum directory sizes to this many levels down (no caching)')
+@click.option('--ttl', default=600, help='How long (seconds) to trust cached listings')
+@click.option('--snapshot/--no-snapshot', default=True, help='Keep the listing cache on disk between sessions')
+@click.option('--threads', default=8, help='Number of concurrent copies for mv')
+def manage(target, depth, ttl, snapshot, threads):
     """ This provides a command line pseudo shell method for managing files """
    
     bits = target.split('/')
@@ -109,7 +164,7 @@ def manage(target):
         cwd = ""
         alias = target
     
-    pfs = PsuedoFileSystem(alias, bucket, cwd)
+    pfs = PsuedoFileSystem(alias, bucket, cwd, max_depth=depth, ttl=ttl, snapshot=snapshot, threads=threads)
 
 if __name__ == "__main__":
    cli()
@@ -1,13 +1,129 @@
 from pathlib import Path
-from minio import Minio
-from s3core import get_user_config
+from minio.commonconfig import CopySource, REPLACE
+from minio.datatypes import Part
+from minio.helpers import MIN_PART_SIZE, MAX_MULTIPART_COUNT
+from s3core import get_user_config, get_client, client_from_credentials, ensure_bucket, size_pool
+from instrument import Span
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import math
 import os
+import queue
+import threading
 import tempfile
+from time import time, sleep
 import numpy as np
 
 
 
-def minio_upload(file_path, credentials, bucket, secure=True, object_name=None, verify=False):
+# Default part size (bytes) for uploads, files no bigger than this are sent in one go.
+DEFAULT_PART_SIZE = 64*1024**2
+
+
+def expected_etag(digests, multipart=None):
+    """
+    The etag S3 will report for an object uploaded with these (binary) part
+    MD5 digests: the plain MD5 for a single put, otherwise (any multipart
+    upload, even of one part) the MD5 of the concatenated part MD5s, suffixed
+    with the number of parts. By default, more than one digest means multipart.
+    See https://stackoverflow.com/questions/62555047/how-is-the-minio-etag-generated
+    """
+    if multipart is None:
+        multipart = len(digests) > 1
+    if not multipart:
+        return digests[0].hex()
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{len(digests)}"
+
+
+def hash_metadata(hashes):
+    """
+    The object metadata in which we record the upload hashes, so
+    that a later audit only needs a HEAD request.
+    """
+    return {'sha256': hashes['sha256'],
+            'upload-etag': hashes['etag'],
+            'part-size': str(hashes['part_size'])}
+
+
+def part_size_for(size, part_size):
+    """
+    The part size we actually use for a file of size bytes, given the one we
+    asked for (adjusted if need be to satisfy the S3 limits on part size and count).
+    """
+    return max(int(part_size), MIN_PART_SIZE, math.ceil(size/MAX_MULTIPART_COUNT))
+
+
+def multipart_upload(client, bucket, object_name, file_path, part_size, parallel=4, retries=3):
+    """
+    Upload the POSIX file at file_path to object_name in bucket as a multipart
+    upload, with parts of part_size bytes (see part_size_for), sent over
+    <parallel> concurrent connections. A part which fails is retried (up to
+    <retries> times) on its own, if it still fails the whole upload is aborted.
+    The file is read once, in order, and we calculate the MD5 of each part and
+    the SHA-256 of the whole file on the way through. Returns a dictionary with
+    the etag we expect S3 to report, the SHA-256, and the part size and count.
+    """
+    size = Path(file_path).stat().st_size
+    part_size = part_size_for(size, part_size)
+    nparts = max(math.ceil(size/part_size), 1)
+    # bound the number of parts held in memory
+    in_hand = threading.BoundedSemaphore(parallel)
+
+    def send(part_number, data):
+        """ Send one part, retrying as necessary """
+        try:
+            for attempt in range(retries+1):
+                try:
+                    etag = client._upload_part(bucket, object_name, data, None, upload_id, part_number)
+                    return Part(part_number, etag)
+                except Exception as error:
+                    if attempt == retries:
+                        raise
+                    print(f'Retrying part {part_number} of {object_name} after: {error}')
+                    sleep(2**attempt)
+        finally:
+            in_hand.release()
+
+    sha256 = hashlib.sha256()
+    digests = []
+    upload_id = client._create_multipart_upload(bucket, object_name, {})
+    try:
+        with open(file_path, 'rb') as fp, ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = []
+            for part_number in range(1, nparts+1):
+                in_hand.acquire()
+                data = fp.read(part_size)
+                sha256.update(data)
+                digests.append(hashlib.md5(data).digest())
+                futures.append(pool.submit(send, part_number, data))
+            parts = [future.result() for future in futures]
+        client._complete_multipart_upload(bucket, object_name, upload_id, parts)
+    except:
+        client._abort_multipart_upload(bucket, object_name, upload_id)
+        raise
+    return {'etag': expected_etag(digests, multipart=True), 'sha256': sha256.hexdigest(),
+            'part_size': part_size, 'parts': nparts}
+
+
+def single_upload(client, bucket, object_name, file_path):
+    """
+    Upload a (small) POSIX file at file_path to object_name in bucket in one
+    put, calculating the hashes from the one read of the file, and storing
+    them as object metadata. Returns the same dictionary as multipart_upload.
+    """
+    with open(file_path, 'rb') as fp:
+        data = fp.read()
+    hashes = {'etag': expected_etag([hashlib.md5(data).digest()]),
+              'sha256': hashlib.sha256(data).hexdigest(),
+              'part_size': len(data), 'parts': 1}
+    client.put_object(bucket, object_name, io.BytesIO(data), len(data),
+                      metadata=hash_metadata(hashes))
+    return hashes
+
+
+def minio_upload(file_path, credentials, bucket, secure=True, object_name=None, verify=False,
+                    part_size=DEFAULT_PART_SIZE, parallel=1):
 
     """ 
     Upload the POSIX file at path to the bucket using the minio 
@@ -18,84 +134,228 @@ def minio_upload(file_path, credentials, bucket, secure=True, object_name=None,
     the filename will be used (sans path).
     If you know that the target is using http rather than https, pass
     secure = False.
-    If you request verification, in principle we can test if the
-    uploaded file is the same as on disk, but at the momement we 
-    can't do that properly.
+    Files bigger than part_size (bytes) are uploaded in parts, using
+    <parallel> concurrent connections.
+    The hashes of the file are calculated as it is uploaded (see
+    multipart_upload), and stored in the object metadata. If you request
+    verification, the etag reported by the server is checked against
+    the one expected from those hashes.
+    Returns the hashes.
+    """
+    client = client_from_credentials(credentials, secure)
+    return client_upload(client, file_path, bucket, object_name=object_name, verify=verify,
+                    part_size=part_size, parallel=parallel)
+
+
+def client_upload(client, file_path, bucket, object_name=None, verify=False,
+                    part_size=DEFAULT_PART_SIZE, parallel=1):
+    """
+    Upload the POSIX file at path to the bucket using a specific client
+    (see minio_upload for details).
     """
-    try:
-        api = {'endpoint':'url','access_key':'accessKey','secret_key':'secretKey'}
-        try:
-            kw = {k:credentials[v] for k,v in api.items()}
-        except KeyError:
-            raise KeyError(f"Cannot find {v} in credentials supplied")
-        kw['secure'] = secure
-        endpoint = kw['endpoint']
-        slashes = endpoint.find('//')
-        if slashes > -1:
-            kw['endpoint'] = endpoint[slashes+2:]
-        client = Minio(**kw)
-    except:
-        raise
     if object_name is None:
         object_name = Path(file_path).stem
     
     #make the bucket if it does not exist
-    try:
-        found = client.bucket_exists(bucket)
-    except:
-        print('** CHECK ENDPOINT ADDRESS and SECURE OPTION')
-        raise
-    if not found:
-        ok = client.make_bucket(bucket)
-        print('Created bucket', bucket)
+    ensure_bucket(client, bucket)
 
     #upload
     try:
-        result = client.fput_object(bucket, object_name, file_path)
-        etag = result.etag
-        if do_verify:
-            size = Path(file_path).stat().st_size
-            do_verify(size, etag, client, bucket, object_name)
+        if part_size is None:
+            part_size = DEFAULT_PART_SIZE
+        size = Path(file_path).stat().st_size
+        # (decided on the part size we would really use, or a file only a little
+        # bigger than a small part_size would go up as a multipart upload of one part)
+        multipart = size > part_size_for(size, part_size)
+        if multipart:
+            hashes = multipart_upload(client, bucket, object_name, file_path, part_size, parallel=parallel)
+        else:
+            hashes = single_upload(client, bucket, object_name, file_path)
+        if verify:
+            do_verify(size, hashes['etag'], client, bucket, object_name)
+        if multipart:
+            # We only know the hashes once the multipart upload is done, so we add
+            # them with a server side copy (which changes the etag, hence verification
+            # first, and we keep the etag of the copy as the object_etag).
+            result = client.copy_object(bucket, object_name, CopySource(bucket, object_name),
+                metadata=hash_metadata(hashes), metadata_directive=REPLACE)
+            hashes['object_etag'] = result.etag.strip('"')
+        return hashes
     except:
         raise
 
 
-def move_to_s3(file_path, target, bucket, testfail=False):
+def move_to_s3(file_path, target, bucket, testfail=False, part_size=None, parallel=1):
     """
     Move <file_path> to <bucket> at the minio <target> (from
     your credential file). NOTE THAT THE FILE AT FILE_PATH
     IS REMOVED FROM DISK AFTER SUCCESSFUL COPY TO S3.
+    Files bigger than <part_size> are uploaded in parts
+    over <parallel> connections (see minio_upload).
 
     <testfail> is used for testing only and should not be
     used in production.
+    Returns the hashes of the file (see client_upload).
     """
-    credentials = get_user_config(target)
-    secure = False
-    if credentials['url'].startswith('https'):
-        secure = True
     try:
-        minio_upload(file_path, credentials, bucket, secure=secure)
+        client = get_client(target)
+        hashes = client_upload(client, file_path, bucket, verify=True,
+                        part_size=part_size, parallel=parallel)
         if testfail:
             raise RuntimeError('Testing failure required')
         os.remove(file_path)
     except:
         raise RuntimeError('Unexpected issue with S3 copy. POSIX file not deleted')
+    return hashes
+
+
+class UploadPipeline:
+    """
+    Move files to S3 (using move_to_s3) in background threads, so that the
+    caller can get on with producing the next file while earlier ones upload.
+    Files are handed over with put, which blocks if there are already
+    <queue_size> files waiting, or if the files not yet uploaded occupy more
+    than <max_pending_bytes> on local disk. As with move_to_s3, the POSIX file
+    is only removed after a successful upload, failures are collected and
+    reported (and raised) by close. If on_uploaded is given, it is called
+    with the file path, size and hashes of each file uploaded, and if on_span
+    is given, it is called with the measurements (see instrument.Span) of every
+    upload, whether or not it worked. Progress is only reported with logging
+    (failures and the summary always are). Any upload_options are passed through to move_to_s3.
+    """
+    def __init__(self, target, bucket, threads=2, queue_size=4, max_pending_bytes=50e9,
+                    on_uploaded=None, on_span=None, logging=True, **upload_options):
+        self.target = target
+        self.logging = logging
+        self.bucket = bucket
+        self.on_uploaded = on_uploaded
+        self.on_span = on_span
+        self.upload_options = upload_options
+        size_pool(threads*(upload_options.get('parallel') or 1))
+        self.max_pending_bytes = max_pending_bytes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.condition = threading.Condition()
+        self.pending_bytes = 0
+        self.failed = []
+        self.stats = {'files':0, 'bytes':0, 'busy':0.0, 'waited':0.0}
+        self.started = time()
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for i in range(threads)]
+        for t in self.threads:
+            t.start()
+
+    def put(self, file_path):
+        """
+        Queue a file for upload, waiting if there is too much in hand already.
+        """
+        size = Path(file_path).stat().st_size
+        e1 = time()
+        with self.condition:
+            while self.pending_bytes > 0 and self.pending_bytes + size > self.max_pending_bytes:
+                self.condition.wait()
+            self.pending_bytes += size
+        self.queue.put((file_path, size))
+        self.stats['waited'] += time()-e1
+
+    def _worker(self):
+        """
+        Drain the queue until told to stop (by a None)
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            file_path, size = item
+            span = Span('upload', bytes_in=size, bytes_out=size, thread=True, file=str(file_path))
+            try:
+                with span:
+                    hashes = move_to_s3(file_path, self.target, self.bucket, **self.upload_options)
+                if self.on_uploaded is not None:
+                    self.on_uploaded(file_path, size, hashes)
+                with self.condition:
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += size
+                    self.stats['busy'] += span.record['wall']
+                if self.logging:
+                    print(f"...file {file_path} moved to s3 in {span.record['wall']:.1f}s")
+            except Exception as error:
+                # anything at all, so that the failure is reported and the thread lives on
+                with self.condition:
+                    self.failed.append((file_path, f'{type(error).__name__}: {error}'))
+                print(f'** Failed to move {file_path} to s3: {error}')
+            finally:
+                if self.on_span is not None and span.record is not None:
+                    try:
+                        self.on_span(span.record)
+                    except Exception as error:
+                        print(f'** Failed to record upload of {file_path}: {error}')
+                with self.condition:
+                    self.pending_bytes -= size
+                    self.condition.notify_all()
+                self.queue.task_done()
+
+    def close(self):
+        """
+        Wait for all the uploads to finish, summarise, and raise an error
+        if any of them failed.
+        """
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.summary()
+        if self.failed:
+            for file_path, error in self.failed:
+                kept = 'retained' if os.path.exists(file_path) else 'removed'
+                print(f'Failed: {file_path} ({error}), POSIX file {kept}')
+            raise RuntimeError(f'{len(self.failed)} files failed to move to S3')
+
+    def abandon(self):
+        """
+        Give up on the files still waiting to upload (they stay on disk), and
+        stop once the uploads already under way are done.
+        """
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                with self.condition:
+                    self.pending_bytes -= item[1]
+                    self.condition.notify_all()
+                print(f'Not uploading {item[0]}')
+            self.queue.task_done()
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def summary(self):
+        """
+        Report upload stage throughput
+        """
+        elapsed = time()-self.started
+        mb = self.stats['bytes']/1e6
+        busy = max(self.stats['busy'], 1e-9)
+        print(f"Upload: {self.stats['files']} files, {mb:.1f}MB in {elapsed:.1f}s elapsed "
+              f"({mb/max(elapsed, 1e-9):.1f}MB/s overall, {mb/busy:.1f}MB/s per thread busy), "
+              f"{len(self.failed)} failed, producer waited {self.stats['waited']:.1f}s")
 
 
 def do_verify(file_size, etag, client, bucket, object_name):
     """ 
-    Ideally we verify the file is correct by first checkging the size in bytes
-    and then we can try and work out whether or not the etag is correct. But the
-    etag is complicated, it's not necessarily the MD5 checksum, so a the moment
-    the second step is not done. A warning is raised.
+    Verify the object is correct by first checking the size in bytes and then
+    checking that the etag is the one we expect (see expected_etag), given the
+    MD5 checksums of the parts we uploaded.
     """
     result = client.stat_object(bucket, object_name)
     object_size = result.size
     if object_size != file_size:
         raise RuntimeError(f'Object size ({object_size}) does not match file size ({file_size})')
-    print(f'Warning - Cannot verify using checksums - but at least file sizes do match for: {object_name}!')
-    # see this useful stackoverflow: 
-    # https://stackoverflow.com/questions/62555047/how-is-the-minio-etag-generated
+    object_etag = result.etag.strip('"')
+    if object_etag != etag:
+        raise RuntimeError(f'Object etag ({object_etag}) does not match expected etag ({etag}) for {object_name}')
 
     
 def test_move_fail(target="hpos", bucket="bnl", secure=False):
@@ -127,6 +387,124 @@ def test_move_succeed(target="hpos", bucket="bnl", secure=False):
         assert not os.path.exists(fname)
         fp.file.close()
        
+class _FlakyClient:
+    """
+    Stand-in for the multipart parts of a Minio client which keeps
+    parts in memory, and fails the first attempt at every part.
+    """
+    def __init__(self):
+        self.parts = {}
+        self.attempts = {}
+        self.objects = {}
+    def _create_multipart_upload(self, bucket, object_name, headers):
+        return 'upload-1'
+    def _upload_part(self, bucket, object_name, data, headers, upload_id, part_number):
+        self.attempts[part_number] = self.attempts.get(part_number, 0) + 1
+        if self.attempts[part_number] == 1:
+            raise ConnectionError('Flaky')
+        self.parts[part_number] = data
+        return f'etag{part_number}'
+    def _complete_multipart_upload(self, bucket, object_name, upload_id, parts):
+        self.objects[object_name] = b''.join(self.parts[p.part_number] for p in parts)
+    def _abort_multipart_upload(self, bucket, object_name, upload_id):
+        raise RuntimeError('Should not need to abort')
+
+
+def test_multipart_retry():
+    """
+    Test that multipart uploads are reassembled in order, with failed parts retried.
+    """
+    client = _FlakyClient()
+    with tempfile.NamedTemporaryFile(delete=False) as fp:
+        data = os.urandom(2*MIN_PART_SIZE+1000)
+        fp.write(data)
+    try:
+        hashes = multipart_upload(client, 'bucket', 'object', fp.name, MIN_PART_SIZE, parallel=3, retries=1)
+    finally:
+        os.remove(fp.name)
+    assert client.objects['object'] == data
+    assert hashes['sha256'] == hashlib.sha256(data).hexdigest()
+    digests = [hashlib.md5(data[i:i+MIN_PART_SIZE]).digest() for i in range(0, len(data), MIN_PART_SIZE)]
+    assert hashes['etag'] == hashlib.md5(b''.join(digests)).hexdigest() + '-3'
+    assert client.attempts == {1:2, 2:2, 3:2}
+    # a single part (multipart) upload still has the multipart form of etag
+    assert expected_etag(digests[:1], multipart=True).endswith('-1')
+    assert part_size_for(MIN_PART_SIZE-1, 1024) == MIN_PART_SIZE
+
+
+def test_pipeline_failures(target="local", bucket="test"):
+    """
+    Test that a failure after the upload (here, in on_uploaded) is reported by
+    close, and that the threads carry on with the other files.
+    """
+    names = []
+    for i in range(4):
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.nc') as fp:
+            fp.write(os.urandom(1000))
+            names.append(fp.name)
+
+    def on_uploaded(file_path, size, hashes):
+        if file_path != names[-1]:
+            raise OSError('Cannot record upload')
+
+    uploader = UploadPipeline(target, bucket, threads=2, queue_size=1, on_uploaded=on_uploaded)
+    for name in names:
+        uploader.put(name)
+    try:
+        uploader.close()
+        raise AssertionError('close should report the failures')
+    except RuntimeError as error:
+        assert '3 files failed' in str(error)
+    assert sorted(f for f, e in uploader.failed) == sorted(names[:-1])
+    assert all('OSError' in e for f, e in uploader.failed)
+
+
+def test_pipeline_abandon(target="local", bucket="test"):
+    """
+    Test that abandoning the pipeline leaves the files still waiting on disk
+    """
+    names = []
+    for i in range(6):
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.nc') as fp:
+            fp.write(os.urandom(1000))
+            names.append(fp.name)
+    started = threading.Event()
+    carry_on = threading.Event()
+
+    def on_uploaded(file_path, size, hashes):
+        started.set()
+        carry_on.wait()
+
+    uploader = UploadPipeline(target, bucket, threads=1, queue_size=10, on_uploaded=on_uploaded)
+    for name in names:
+        uploader.put(name)
+    started.wait()
+    carry_on.set()
+    uploader.abandon()
+    kept = [name for name in names if os.path.exists(name)]
+    assert len(kept) >= 4 and uploader.pending_bytes == 0
+    for name in kept:
+        os.remove(name)
+
+
+def test_multipart(target="local", bucket="test", secure=False):
+    """
+    Test a multipart upload against a real (or local MinIO) server
+    """
+    with tempfile.NamedTemporaryFile(delete=False) as fp:
+        data = os.urandom(2*MIN_PART_SIZE+1000)
+        fp.write(data)
+    credentials = get_user_config(target)
+    hashes = minio_upload(fp.name, credentials, bucket, secure=secure,
+        object_name='test_multipart_delete_at_whenever', verify=True,
+        part_size=MIN_PART_SIZE, parallel=3)
+    os.remove(fp.name)
+    stat = get_client(target).stat_object(bucket, 'test_multipart_delete_at_whenever')
+    assert stat.metadata['X-Amz-Meta-Sha256'] == hashes['sha256']
+    assert stat.metadata['X-Amz-Meta-Upload-Etag'] == hashes['etag']
+    assert stat.etag.strip('"') == hashes['object_etag']
+
+
 def testme(target="hpos", bucket="bnl", secure=True):
     """
     Copies this file to the bucket at target. Used for testing
@@ -0,0 +1,193 @@
+import sqlite3
+from collections import defaultdict
+from pathlib import Path
+from time import time
+
+# Where we keep usage indexes
+USAGE_DIR = Path.home()/'.cache'/'pp2nice'
+# Allowance (seconds) for clock differences between us and the object store
+SKEW = 300
+
+SCHEMA = """
+create table if not exists objects (name text primary key, size integer, modified real) without rowid;
+create table if not exists usage (prefix text primary key, depth integer, bytes integer, objects integer);
+create table if not exists previous (prefix text primary key, depth integer, bytes integer, objects integer);
+create table if not exists runs (run integer primary key, started real, seconds real,
+                                 listed integer, changed integer, removed integer, bytes integer, objects integer);
+create index if not exists usage_depth on usage (depth, bytes);
+"""
+
+
+def ancestors(name):
+    """ All the "directory" prefixes of an object name, from the bucket ('') down """
+    bits = name.split('/')[:-1]
+    prefixes = ['']
+    for bit in bits:
+        prefixes.append(prefixes[-1] + bit + '/')
+    return prefixes
+
+
+class UsageIndex:
+    """
+    A persistent (sqlite) index of the bytes and objects under every prefix
+    in a bucket. Each update has to list the whole bucket (S3 can't list by
+    date), but only objects modified since the last run (the high-water mark)
+    are looked up and re-summed, and objects which have gone are found with one
+    set difference, so updates of big, slowly changing buckets are cheap. The
+    sums from the run before are kept, so we can report growth.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def for_bucket(cls, alias, bucket):
+        """ The default index for a bucket """
+        return cls(USAGE_DIR/f'usage-{alias}-{bucket}.sqlite')
+
+    def high_water_mark(self):
+        """ Objects modified before this were seen by the last run """
+        row = self.db.execute('select max(started) from runs').fetchone()
+        return row[0] - SKEW if row[0] is not None else None
+
+    def update(self, client, bucket):
+        """ Update the index from a (recursive) listing of the bucket """
+        return self.apply(client.list_objects(bucket, recursive=True))
+
+    def apply(self, objects):
+        """
+        Update the index from a complete listing (minio objects). Returns a
+        dictionary describing the run.
+        """
+        started = time()
+        hwm = self.high_water_mark()
+        db = self.db
+        deltas = defaultdict(lambda: [0, 0])
+        listed, changed = 0, 0
+
+        def bump(name, dbytes, dobjects):
+            for prefix in ancestors(name):
+                d = deltas[prefix]
+                d[0] += dbytes
+                d[1] += dobjects
+
+        db.execute('create temp table if not exists listed (name text primary key) without rowid')
+        db.execute('delete from listed')
+        names, updates = [], []
+        for o in objects:
+            listed += 1
+            names.append((o.object_name,))
+            modified = o.last_modified.timestamp()
+            if hwm is None or modified > hwm:
+                old = None if hwm is None else db.execute(
+                            'select size, modified from objects where name=?', (o.object_name,)).fetchone()
+                if old is None:
+                    bump(o.object_name, o.size, 1)
+                elif old[1] != modified or old[0] != o.size:
+                    bump(o.object_name, o.size - old[0], 0)
+                else:
+                    continue
+                changed += 1
+                updates.append((o.object_name, o.size, modified))
+            if len(names) >= 100_000:
+                db.executemany('insert or ignore into listed values (?)', names)
+                names = []
+        db.executemany('insert or ignore into listed values (?)', names)
+
+        removed = 0
+        if hwm is not None:
+            for name, size in db.execute(
+                    'select name, size from objects where name not in (select name from listed)').fetchall():
+                bump(name, -size, -1)
+                removed += 1
+            db.execute('delete from objects where name not in (select name from listed)')
+        db.executemany('insert or replace into objects values (?,?,?)', updates)
+
+        db.execute('delete from previous')
+        db.execute('insert into previous select * from usage')
+        db.executemany("""insert into usage values (?,?,?,?) on conflict(prefix) do update set
+                          bytes=bytes+excluded.bytes, objects=objects+excluded.objects""",
+                       [(p, p.count('/'), b, n) for p, (b, n) in deltas.items()])
+        db.execute("delete from usage where objects <= 0 and prefix != ''")
+        total = self.get('')
+        run = {'started': started, 'seconds': time()-started, 'listed': listed, 'changed': changed,
+               'removed': removed, 'bytes': total[0], 'objects': total[1]}
+        db.execute('insert into runs (started, seconds, listed, changed, removed, bytes, objects) values (?,?,?,?,?,?,?)',
+                   tuple(run.values()))
+        db.commit()
+        return run
+
+    def get(self, prefix):
+        """ (bytes, objects) under prefix """
+        row = self.db.execute('select bytes, objects from usage where prefix=?', (prefix,)).fetchone()
+        return tuple(row) if row else (0, 0)
+
+    def top(self, n=10, prefix='', depth=1):
+        """
+        The n biggest prefixes (as prefix, bytes, objects) which are depth
+        levels below prefix
+        """
+        return self.db.execute("""select prefix, bytes, objects from usage where depth=? and prefix like ? escape '\\'
+                                  order by bytes desc limit ?""",
+                               (prefix.count('/') + depth, _like(prefix), n)).fetchall()
+
+    def growth(self, n=10, prefix='', depth=1):
+        """
+        The n prefixes (depth levels below prefix) which have grown most since
+        the run before last, as prefix, bytes, objects, change in bytes, change in objects
+        """
+        return self.db.execute("""select u.prefix, u.bytes, u.objects, u.bytes-coalesce(p.bytes,0) as db,
+                                  u.objects-coalesce(p.objects,0)
+                                  from usage u left join previous p on u.prefix=p.prefix
+                                  where u.depth=? and u.prefix like ? escape '\\' order by db desc limit ?""",
+                               (prefix.count('/') + depth, _like(prefix), n)).fetchall()
+
+    def runs(self):
+        """ When the index was updated, and what was found """
+        return self.db.execute('select * from runs order by run').fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def _like(prefix):
+    """ A like pattern for everything starting with prefix """
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def test_usage():
+    """
+    Build an index from fake listings, update it, and check the sums
+    """
+    import tempfile
+    from datetime import datetime, timezone
+
+    class O:
+        def __init__(self, name, size, when):
+            self.object_name, self.size = name, size
+            self.last_modified = datetime.fromtimestamp(when, timezone.utc)
+
+    old = time() - 10*SKEW
+    listing = [O('u-ch330/1hr/a.nc', 100, old), O('u-ch330/1hr/b.nc', 100, old),
+               O('u-ch330/mon/c.nc', 10, old), O('u-ck777/1hr/d.nc', 50, old), O('top.txt', 1, old)]
+    with tempfile.TemporaryDirectory() as tmp:
+        index = UsageIndex(Path(tmp)/'usage.sqlite')
+        run = index.apply(listing)
+        assert run['changed'] == 5 and run['bytes'] == 261
+        assert index.top(2) == [('u-ch330/', 210, 3), ('u-ck777/', 50, 1)]
+        assert index.top(5, 'u-ch330/') == [('u-ch330/1hr/', 200, 2), ('u-ch330/mon/', 10, 1)]
+        # one new file, one replaced, one gone
+        listing = listing[1:] + [O('u-ck777/1hr/e.nc', 500, time())]
+        listing[0] = O('u-ch330/1hr/b.nc', 150, time())
+        run = index.apply(listing)
+        assert (run['changed'], run['removed'], run['bytes']) == (2, 1, 711), run
+        assert index.get('u-ch330/1hr/') == (150, 1)
+        assert index.growth(1) == [('u-ck777/', 550, 2, 500, 1)]
+        assert index.get('u-ch330/') == (160, 2)
+        index.close()
+
+
+if __name__ == "__main__":
+    test_usage()
@@ -0,0 +1,344 @@
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+from pathlib import Path
+from time import time, sleep
+from uuid import uuid4
+
+STATES = ('pending', 'claimed', 'done', 'failed')
+
+
+class ClaimLost(RuntimeError):
+    """ Our claim on a task was handed on (as stale), so we must stop working on it """
+
+
+class WorkQueue:
+    """
+    A queue of numbered tasks held as files on a shared file system, with
+    one directory for each state (pending, claimed, done, failed). Tasks move
+    between states by (atomic) rename, so any number of workers can claim
+    tasks without a lock or a server: whoever renames a pending task first
+    has it. A claimed task's file is named for the claim (task.claim), so a
+    worker can only touch or finish its own claim. Workers touch their claimed
+    tasks as a heartbeat, and claims which have not been touched for a while
+    are returned to pending. A status record (json) is kept for each task in
+    the status directory.
+    """
+    def __init__(self, root, stale_after=900, max_attempts=3):
+        self.root = Path(root)
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        # our claims, task to claimed file
+        self.claims = {}
+        for d in STATES + ('status',):
+            (self.root/d).mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _name(task):
+        return f'{task:06d}'
+
+    def _path(self, state, task):
+        return self.root/state/self._name(task)
+
+    @staticmethod
+    def _task(path):
+        """ The task a queue file is for (claimed files have the claim after a dot) """
+        return int(path.name.split('.')[0])
+
+    def populate(self, ntasks):
+        """
+        Put tasks 0..ntasks-1 in the queue, unless they are already in it (in any
+        state), so it is safe for every worker to do this at startup.
+        """
+        known = set()
+        for state in STATES:
+            known.update(self._name(self._task(p)) for p in (self.root/state).iterdir())
+        added = 0
+        for task in range(ntasks):
+            if self._name(task) in known:
+                continue
+            try:
+                fd = os.open(self._path('pending', task), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue
+            os.close(fd)
+            added += 1
+        return added
+
+    def _record(self, task):
+        try:
+            with open(self.root/'status'/f'{self._name(task)}.json') as sfile:
+                return json.load(sfile)
+        except (OSError, json.JSONDecodeError):
+            return {'task': task, 'attempts': 0}
+
+    def _save_record(self, task, record):
+        path = self.root/'status'/f'{self._name(task)}.json'
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with open(tmp, 'w') as sfile:
+            json.dump(record, sfile)
+        os.replace(tmp, path)
+
+    def claim(self, worker):
+        """
+        Claim the next pending task for worker, returning the task number,
+        or None if there is nothing pending.
+        """
+        for path in sorted((self.root/'pending').iterdir()):
+            task = self._task(path)
+            claim = uuid4().hex[:12]
+            claimed = self.root/'claimed'/f'{self._name(task)}.{claim}'
+            try:
+                # touch it first, since rename keeps the old time, which reclaim would see as stale
+                os.utime(path)
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # somebody else got there first
+                continue
+            self.claims[task] = claimed
+            record = self._record(task)
+            record.update({'state': 'claimed', 'worker': worker, 'claim': claim, 'host': socket.gethostname(),
+                           'pid': os.getpid(), 'started': time(), 'attempts': record.get('attempts', 0) + 1})
+            record.pop('error', None)
+            self._save_record(task, record)
+            return task
+        return None
+
+    def heartbeat(self, task):
+        """ Show we are still working on task, returning False if we have lost our claim """
+        try:
+            os.utime(self.claims[task])
+            return True
+        except (KeyError, FileNotFoundError):
+            return False
+
+    def owns(self, task):
+        """ Do we still hold our claim on task? """
+        claimed = self.claims.get(task)
+        return claimed is not None and claimed.exists()
+
+    def finish(self, task, error=None):
+        """
+        Record that we have finished a task we claimed. If it failed (error is the reason)
+        it goes back to pending unless it has used up its attempts.
+        Returns the new state ('lost' if our claim was handed on, in which
+        case nothing is changed).
+        """
+        claimed = self.claims.pop(task, None)
+        if claimed is None or not claimed.exists():
+            return 'lost'
+        record = self._record(task)
+        if error is None:
+            state = 'done'
+        elif record.get('attempts', 0) < self.max_attempts:
+            state = 'pending'
+        else:
+            state = 'failed'
+        try:
+            os.rename(claimed, self._path(state, task))
+        except FileNotFoundError:
+            # our claim went stale and the task was handed on
+            return 'lost'
+        finished = time()
+        record.update({'state': state, 'finished': finished,
+                       'seconds': finished - record.get('started', finished)})
+        if error is not None:
+            record['error'] = error
+        self._save_record(task, record)
+        return state
+
+    def reclaim(self):
+        """
+        Put claimed tasks whose heartbeat has stopped back in pending (or failed,
+        if they have used up their attempts). Returns the tasks reclaimed.
+        """
+        reclaimed = []
+        now = time()
+        for path in (self.root/'claimed').iterdir():
+            try:
+                if now - path.stat().st_mtime < self.stale_after:
+                    continue
+            except FileNotFoundError:
+                continue
+            task = self._task(path)
+            record = self._record(task)
+            state = 'pending' if record.get('attempts', 0) < self.max_attempts else 'failed'
+            try:
+                os.rename(path, self._path(state, task))
+            except FileNotFoundError:
+                continue
+            record.update({'state': state, 'error': f"worker {record.get('worker')} stopped responding"})
+            self._save_record(task, record)
+            reclaimed.append(task)
+        return reclaimed
+
+    def counts(self):
+        """ How many tasks are in each state """
+        return {state: len(os.listdir(self.root/state)) for state in STATES}
+
+    def records(self):
+        """ The status records of all the tasks """
+        return [self._record(self._task(p)) for state in STATES for p in (self.root/state).iterdir()]
+
+
+class Heartbeat:
+    """
+    Context manager which keeps a claimed task alive from a background thread
+    """
+    def __init__(self, queue, task, interval=60):
+        self.queue, self.task, self.interval = queue, task, interval
+        self._stop = threading.Event()
+        self.lost = False
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            if not self.queue.heartbeat(self.task):
+                self.lost = True
+                print(f'Lost our claim on task {self.task}')
+                return
+
+    def check(self):
+        """ Raise ClaimLost if our claim on the task has gone, so that the work stops """
+        if self.lost or not self.queue.owns(self.task):
+            self.lost = True
+            raise ClaimLost(f'Lost our claim on task {self.task}')
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue, work, worker=None, interval=60, poll=30, linger=True):
+    """
+    Keep claiming tasks from the queue and calling work(task, check) on them until
+    there are none left. The work should call check() between steps: it raises
+    ClaimLost if our claim has been handed on (e.g. the heartbeat stalled), and
+    then we abandon the task, since another worker will be doing it.
+    With linger, we wait (reclaiming stale tasks) until every
+    claimed task is finished, so that the tasks of dead workers get done.
+    Returns the tasks this worker completed.
+    """
+    worker = worker or f'{socket.gethostname()}:{os.getpid()}'
+    completed = []
+    while True:
+        queue.reclaim()
+        task = queue.claim(worker)
+        if task is None:
+            counts = queue.counts()
+            if not linger or counts['claimed'] == 0:
+                break
+            sleep(poll)
+            continue
+        print(f'Worker {worker} starting task {task}')
+        error = None
+        with Heartbeat(queue, task, interval) as heartbeat:
+            try:
+                work(task, heartbeat.check)
+            except ClaimLost as lost:
+                print(f'Worker {worker} abandoning task {task}: {lost}')
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+        # (if our claim was lost, this just drops it)
+        state = queue.finish(task, error)
+        print(f'Worker {worker} task {task}: {state}')
+        if state == 'done':
+            completed.append(task)
+    return completed
+
+
+def test_queue():
+    """
+    Several workers sharing a queue, with a failing task which succeeds on
+    retry, and a task claimed by a worker which died.
+    """
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = WorkQueue(tmp, stale_after=0.5, max_attempts=2)
+        assert queue.populate(10) == 10 and queue.populate(10) == 0
+        # a worker claims task 0 and dies
+        assert queue.claim('dead') == 0
+        tries = {}
+        lock = threading.Lock()
+
+        def work(task, check):
+            with lock:
+                tries[task] = tries.get(task, 0) + 1
+            if task == 3 and tries[task] == 1:
+                raise RuntimeError('transient')
+            if task == 7:
+                raise RuntimeError('permanent')
+            sleep(0.05)
+
+        done = []
+        workers = [threading.Thread(target=lambda i=i: done.extend(
+                        run_worker(WorkQueue(tmp, stale_after=0.5, max_attempts=2), work,
+                                   worker=f'w{i}', interval=0.1, poll=0.1)))
+                   for i in range(3)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        assert queue.counts() == {'pending': 0, 'claimed': 0, 'done': 9, 'failed': 1}
+        assert sorted(done) == [t for t in range(10) if t != 7]
+        assert tries[3] == 2 and tries[7] == 2
+        records = {r['task']: r for r in queue.records()}
+        assert records[0]['attempts'] == 2 and records[0]['state'] == 'done'
+        assert 'permanent' in records[7]['error']
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # a stale worker can't touch or finish the claim which replaced its own
+        slow, fast = (WorkQueue(tmp, stale_after=60) for i in range(2))
+        slow.populate(1)
+        assert slow.claim('slow') == 0
+        assert slow.reclaim() == []
+        for path in (Path(tmp)/'claimed').iterdir():
+            os.utime(path, (time()-120, time()-120))
+        assert fast.reclaim() == [0]
+        assert fast.claim('fast') == 0
+        assert not slow.heartbeat(0) and slow.finish(0, 'too slow') == 'lost'
+        assert fast.heartbeat(0) and fast.finish(0) == 'done'
+        assert fast.counts() == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # a worker whose heartbeat stalls stops work on the task once it is handed on
+        slow, fast = WorkQueue(tmp, stale_after=0.3), WorkQueue(tmp, stale_after=0.3)
+        slow.populate(1)
+        steps = []
+
+        def stalled(task, check):
+            for i in range(200):
+                check()
+                steps.append(i)
+                sleep(0.01)
+
+        done = []
+        worker = threading.Thread(target=lambda: done.extend(
+                    run_worker(slow, stalled, worker='slow', interval=60, linger=False)))
+        worker.start()
+        sleep(0.5)
+        assert fast.reclaim() == [0] and fast.claim('fast') == 0
+        worker.join()
+        assert done == [] and len(steps) < 200 and slow.claims == {}
+        assert fast.finish(0) == 'done'
+        assert fast.counts() == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['status']:
+        # python workqueue.py status queue_dir
+        queue = WorkQueue(sys.argv[2])
+        print(queue.counts())
+        for record in sorted(queue.records(), key=lambda r: r['task']):
+            if record.get('state') in ('claimed', 'failed'):
+                print(record)
+        sys.exit()
+    test_queue()